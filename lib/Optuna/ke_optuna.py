@@ -1,9 +1,14 @@
 import argparse
 import json
+import multiprocessing
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import catboost as cb
+import numpy as np
 import optuna
 import pandas as pd
 from catboost import Pool
@@ -13,6 +18,33 @@ from sklearn.metrics import accuracy_score
 from sklearn.model_selection import StratifiedKFold
 from sklearn.model_selection import train_test_split
 
+PRUNERS = {
+    "none": optuna.pruners.NopPruner,
+    "median": optuna.pruners.MedianPruner,
+    "successive_halving": optuna.pruners.SuccessiveHalvingPruner,
+    "hyperband": optuna.pruners.HyperbandPruner,
+}
+
+
+def fidelity_stage(stage):
+    """
+    This method parses a multi-fidelity stage FRACTION:ITERATIONS:TRIALS[:KFOLD], see --fidelity
+    :return: {'fraction': float, 'iterations': int, 'n_trials': int, 'kfold': int or None}
+    :rtype: dict
+    """
+    fields = stage.split(":")
+    try:
+        if len(fields) not in (3, 4):
+            raise ValueError
+        stage = {'fraction': float(fields[0]), 'iterations': int(fields[1]), 'n_trials': int(fields[2]),
+                 'kfold': int(fields[3]) if len(fields) == 4 else None}
+    except ValueError:
+        raise argparse.ArgumentTypeError("fidelity stage should be FRACTION:ITERATIONS:TRIALS[:KFOLD], got " + stage)
+    if not 0 < stage['fraction'] <= 1 or stage['iterations'] < 1 or stage['n_trials'] < 1:
+        raise argparse.ArgumentTypeError("fidelity stage needs 0 < FRACTION <= 1, ITERATIONS >= 1 and TRIALS >= 1")
+    return stage
+
+
 # add arg parser
 parser = argparse.ArgumentParser(description="Catboost model hyper-parameter selection")
 parser.add_argument("study_name", help="name of study")
@@ -21,60 +53,356 @@ parser.add_argument("output_folder", help="output folder path")
 parser.add_argument("sampler", help="Optuna sampler", choices=["RandomSampler", "TPESampler", "CmaEsSampler"])
 parser.add_argument("-k", "--kfold", default=5, type=int, help="k fold validation")
 parser.add_argument("-t", "--trial_number", default=100, type=int, help="total number of trials in an Optuna study")
+parser.add_argument("-p", "--pruner", default="none", choices=list(PRUNERS),
+                    help="Optuna pruner stopping unpromising trials early, the mean test accuracy of the finished folds "
+                         "is reported after every fold")
+parser.add_argument("--prune_iterations", action='store_true',
+                    help="report the validation accuracy of every CatBoost iteration instead of every fold, so trials "
+                         "can be pruned inside a fold. CPU only, CatBoost doesn't support callbacks on GPU")
+parser.add_argument("-f", "--fidelity", nargs="+", type=fidelity_stage, default=[], metavar="STAGE",
+                    help="multi-fidelity search, stages FRACTION:ITERATIONS:TRIALS[:KFOLD] run before the full study, "
+                         "e.g. 0.1:200:100:2 0.3:500:30. A stage evaluates configurations with a stratified FRACTION of "
+                         "the rows, at most ITERATIONS CatBoost iterations and KFOLD folds (default --kfold). The first "
+                         "stage samples TRIALS configurations, every later stage and the full study only evaluate the "
+                         "best TRIALS (trial_number) configurations of the stage before")
+parser.add_argument("--fold_jobs", default=1, type=int,
+                    help="number of folds trained concurrently in worker processes, each with thread_count CatBoost "
+                         "threads. The n_jobs concurrent trials share the fold_jobs processes. With thread_count -1, "
+                         "each fold gets cores / fold_jobs threads")
 parser.add_argument("-r", "--resume", action='store_true',
                     help="if resume from an existing study. It will complete the trial number if not finished by previous study")
-global args
-args = parser.parse_args()
+parser.add_argument("--task_type", default="GPU", choices=["GPU", "CPU"], help="CatBoost device")
+parser.add_argument("--thread_count", default=-1, type=int,
+                    help="CatBoost threads per fold, -1 splits the cores between the n_jobs concurrent trials, or "
+                         "between the fold_jobs processes. On CPU, n_jobs x thread_count should not exceed the number "
+                         "of cores")
+parser.add_argument("-j", "--n_jobs", default=1, type=int, help="number of trials run concurrently by this process")
+parser.add_argument("--storage", default=None,
+                    help="Optuna storage URL, e.g. mysql://user@host/db. Default is sqlite:///<study_name>.db "
+                         "in the output folder")
+parser.add_argument("-w", "--worker", action='store_true',
+                    help="worker mode: attach to the study in the storage, created if missing and never deleted, and "
+                         "run trials until the study has trial_number trials. Start several workers on one or more "
+                         "nodes with the same study_name and storage")
+
+
+def load_data(input_file):
+    """
+    This method loads the dataset once, so trials don't reload it
+    :param input_file: pickled dataset, 'biome' label column first and features after
+    :type input_file: string
+    :return: features, labels
+    :rtype: pandas dataframe, pandas series
+    """
+    df = pd.read_pickle(input_file)
+    return df.iloc[:, 1:], df['biome']
+
+
+def make_folds(y, kfold):
+    """
+    This method computes the row positions of every fold once, so trials don't resplit the data
+    :param y: labels
+    :type y: pandas series
+    :param kfold: number of folds
+    :type kfold: int
+    :return: [(train positions, validation positions, test positions) of every fold]
+    :rtype: list
+    """
+    skf = StratifiedKFold(n_splits=kfold)
+    folds = []
+    for train_val, test in skf.split(np.zeros(len(y)), y):
+        train, val = train_test_split(train_val, random_state=42, test_size=0.22, stratify=y.iloc[train_val])
+        folds.append((train, val, test))
+    return folds
+
+
+def stratified_subsample(y, fraction):
+    """
+    This method samples a stratified fraction of the rows
+    :param y: labels
+    :type y: pandas series
+    :param fraction: fraction of rows to keep, 1 keeps all
+    :type fraction: float
+    :return: sorted row positions
+    :rtype: numpy array
+    """
+    positions = np.arange(len(y))
+    if fraction >= 1:
+        return positions
+    subsample, _ = train_test_split(positions, train_size=fraction, random_state=42, stratify=y)
+    return np.sort(subsample)
+
+
+def build_pools(X, y, folds, borders_dir, task_type="GPU", border_count=None):
+    """
+    This method builds the CatBoost pools of every fold once. Train pools are quantized once and validation and
+    test pools are quantized with the borders of their train pool, which are saved as
+    borders_dir/fold_<i>_borders.tsv. Trials reuse the pools, so features are not quantized again for every trial.
+    Labels are replaced by their index in the sorted classes, CatBoost can't save quantized pools with string labels
+    :param X: features
+    :type X: pandas dataframe
+    :param y: labels
+    :type y: pandas series
+    :param folds: row positions of every fold, see make_folds
+    :type folds: list
+    :param borders_dir: directory of the quantization borders files
+    :type borders_dir: string
+    :param task_type: CatBoost device the pools are trained on, its default border count is used (128 on GPU, 254 on CPU)
+    :type task_type: string
+    :param border_count: number of borders of every feature, None uses the default of task_type
+    :type border_count: int
+    :return: [(train pool, validation pool, test pool, test label indices) of every fold]
+    :rtype: list
+    """
+    _, labels = np.unique(y.to_numpy(), return_inverse=True)
+    pools = []
+    for i, (train, val, test) in enumerate(folds):
+        train_pool = Pool(data=X.iloc[train], label=labels[train])
+        train_pool.quantize(border_count=border_count, task_type=task_type)
+        # workers sharing borders_dir, possibly with the same pid on different nodes, write their own file first
+        # and then replace the shared one
+        borders_file = os.path.join(borders_dir, "fold_{}_borders.tsv".format(i))
+        fd, process_borders_file = tempfile.mkstemp(prefix="fold_{}_borders.".format(i), suffix=".tsv",
+                                                    dir=borders_dir)
+        os.close(fd)
+        train_pool.save_quantization_borders(process_borders_file)
+        val_pool = Pool(data=X.iloc[val], label=labels[val])
+        val_pool.quantize(input_borders=process_borders_file)
+        test_pool = Pool(data=X.iloc[test], label=labels[test])
+        test_pool.quantize(input_borders=process_borders_file)
+        os.replace(process_borders_file, borders_file)
+        pools.append((train_pool, val_pool, test_pool, labels[test]))
+    return pools
+
+
+def save_pools(pools, pools_dir):
+    """
+    This method saves the quantized pools of every fold, so fold worker processes can load them
+    :param pools: pools of every fold, see build_pools
+    :type pools: list
+    :param pools_dir: output directory
+    :type pools_dir: string
+    :return: None
+    """
+    for fold, (train_pool, val_pool, test_pool, y_test) in enumerate(pools):
+        train_pool.save(os.path.join(pools_dir, "fold_{}_train.bin".format(fold)))
+        val_pool.save(os.path.join(pools_dir, "fold_{}_val.bin".format(fold)))
+        test_pool.save(os.path.join(pools_dir, "fold_{}_test.bin".format(fold)))
+        np.save(os.path.join(pools_dir, "fold_{}_test_labels.npy".format(fold)), y_test)
+
+
+def load_fold_pools(pools_dir, fold):
+    """
+    This method loads the pools of one fold saved by save_pools
+    :return: train pool, validation pool, test pool, test label indices
+    :rtype: catboost.Pool, catboost.Pool, catboost.Pool, numpy array
+    """
+    return (Pool("quantized://" + os.path.join(pools_dir, "fold_{}_train.bin".format(fold))),
+            Pool("quantized://" + os.path.join(pools_dir, "fold_{}_val.bin".format(fold))),
+            Pool("quantized://" + os.path.join(pools_dir, "fold_{}_test.bin".format(fold))),
+            np.load(os.path.join(pools_dir, "fold_{}_test_labels.npy".format(fold))))
+
+
+def train_fold(params, train_pool, val_pool, test_pool, y_test, task_type="GPU", thread_count=-1, callbacks=None):
+    """
+    This method trains a CatBoost classifier on one fold
+    :return: test accuracy
+    :rtype: float
+    """
+    gbm = cb.CatBoostClassifier(
+        custom_metric='Accuracy',
+        random_seed=42,
+        task_type=task_type,
+        thread_count=thread_count,
+        **params)
+    gbm.fit(train_pool, eval_set=val_pool, verbose=0, early_stopping_rounds=100, callbacks=callbacks)
+    preds = gbm.predict(test_pool).ravel().astype(y_test.dtype)
+    return accuracy_score(y_test, preds)
+
 
+# pools of the folds a fold worker process has trained, loaded on first use
+_fold_pools = {}
 
-def objective(trial: optuna.Trial):
-    file_path = args.input_file
-    df = pd.read_pickle(file_path)
-    X = df.iloc[:, 1:]
-    y = df['biome']
-    skf = StratifiedKFold(n_splits=args.kfold)
+
+def _train_saved_fold(pools_dir, fold, params, task_type, thread_count):
+    if fold not in _fold_pools:
+        _fold_pools[fold] = load_fold_pools(pools_dir, fold)
+    return train_fold(params, *_fold_pools[fold], task_type, thread_count)
+
+
+class IterationPruningCallback:
+    def __init__(self, trial, step_offset):
+        """
+        CatBoost callback reporting the validation accuracy of every iteration to the trial at step
+        step_offset + iteration. It stops training once the trial should be pruned
+        :param trial: Optuna trial
+        :type trial: optuna.Trial
+        :param step_offset: step of iteration 0
+        :type step_offset: int
+        """
+        self.trial = trial
+        self.step_offset = step_offset
+        self.pruned = False
+
+    def after_iteration(self, info):
+        self.trial.report(info.metrics['validation']['Accuracy'][-1], self.step_offset + info.iteration)
+        self.pruned = self.trial.should_prune()
+        return not self.pruned
+
+
+def objective(trial: optuna.Trial, pools, task_type="GPU", thread_count=-1, prune_iterations=False,
+              fold_executor=None, pools_dir=None, iterations=None):
+    params = {
+        'depth': trial.suggest_int("depth", 4, 10, step=2),  # Maximum tree depth is 16
+        'learning_rate': trial.suggest_float("learning_rate", 0.1, 0.3, step=0.05),
+        'l2_leaf_reg': trial.suggest_int("l2_leaf_reg", 2, 4, step=1),
+        'random_strength': trial.suggest_int("random_strength", 1, 5, step=1),
+        'bagging_temperature': trial.suggest_int("bagging_temperature", 0, 5, step=1),
+    }
+    if iterations is not None:
+        # low fidelity, not a searched parameter
+        params['iterations'] = iterations
+    if fold_executor is not None:
+        # train all folds concurrently from the saved pools, results are collected in fold order
+        futures = [fold_executor.submit(_train_saved_fold, pools_dir, fold, params, task_type, thread_count)
+                   for fold in range(len(pools))]
+        results = (future.result() for future in futures)
+    else:
+        results = None
     acc_test = []
-    for train_val, test in skf.split(X, y):
-        X_train_val, y_train_val = X.iloc[train_val], y.iloc[train_val]
-        X_test, y_test = X.iloc[test], y.iloc[test]
-        X_train, X_val, y_train, y_val = train_test_split(X_train_val, y_train_val, random_state=42, test_size=0.22,
-                                                          stratify=y_train_val)
-
-        # 1. train pool
-        X_train_pool = Pool(
-            data=X_train,
-            label=y_train,
-        )
-        X_val_pool = Pool(
-            data=X_val,
-            label=y_val,
-        )
-        # 2. Init the model
-        params = {
-            'depth': trial.suggest_int("depth", 4, 10, step=2),  # Maximum tree depth is 16
-            'learning_rate': trial.suggest_float("learning_rate", 0.1, 0.3, step=0.05),
-            'l2_leaf_reg': trial.suggest_int("l2_leaf_reg", 2, 4, step=1),
-            'random_strength': trial.suggest_int("random_strength", 1, 5, step=1),
-            'bagging_temperature': trial.suggest_int("bagging_temperature", 0, 5, step=1),
-        }
-        gbm = cb.CatBoostClassifier(
-            custom_metric='Accuracy',
-            random_seed=42,
-            task_type="GPU",
-            **params)
-
-        # 3. training
-        gbm.fit(X_train_pool, eval_set=X_val_pool, verbose=0, early_stopping_rounds=100)
-
-        # 4. predict
-        preds = gbm.predict(X_test)
-        acc = accuracy_score(y_test, preds)
+    for fold, (train_pool, val_pool, test_pool, y_test) in enumerate(pools):
+        if results is not None:
+            acc = next(results)
+        elif prune_iterations:
+            callback = IterationPruningCallback(trial, fold * params.get('iterations', 1000))
+            acc = train_fold(params, train_pool, val_pool, test_pool, y_test, task_type, thread_count, [callback])
+            if callback.pruned:
+                raise optuna.TrialPruned()
+        else:
+            acc = train_fold(params, train_pool, val_pool, test_pool, y_test, task_type, thread_count)
         acc_test.append(acc)
+        if not prune_iterations:
+            # mean accuracy of the folds so far
+            trial.report(sum(acc_test) / len(acc_test), fold)
+            if trial.should_prune():
+                if results is not None:
+                    for future in futures:
+                        future.cancel()
+                raise optuna.TrialPruned()
+
+    return sum(acc_test) / len(pools)
+
 
-    return sum(acc_test) / args.kfold
+def thread_budget(thread_count, n_jobs=1, fold_jobs=1):
+    """
+    This method picks the CatBoost threads of every fold, thread_count -1 splits the cores between the folds trained
+    concurrently, by the fold_jobs processes or else by the n_jobs trials
+    :param thread_count: CatBoost threads of a fold, -1 to split the cores
+    :type thread_count: int
+    :param n_jobs: number of trials run concurrently
+    :type n_jobs: int
+    :param fold_jobs: number of fold worker processes, shared by the n_jobs trials
+    :type fold_jobs: int
+    :return: CatBoost threads of a fold, -1 for all cores
+    :rtype: int
+    """
+    if thread_count != -1:
+        return thread_count
+    if fold_jobs > 1:
+        # the trials share one pool, at most fold_jobs folds run at once
+        return max(1, (os.cpu_count() or 1) // fold_jobs)
+    if n_jobs > 1:
+        # every concurrent trial trains one fold at a time
+        return max(1, (os.cpu_count() or 1) // n_jobs)
+    return thread_count
 
 
-def ke_optuna(study_name, sampler, n_trials, output_dir):
+def run_trials(study, pools, work_dir, n_trials, n_jobs=1, callbacks=None, fold_jobs=1, iterations=None,
+               task_type="GPU", thread_count=-1, prune_iterations=False):
+    """
+    This method runs n_trials trials of study on the pools of every fold. With fold_jobs > 1 the pools are saved in
+    a temporary directory of work_dir and the folds of all trials are trained in one pool of fold_jobs processes.
+    task_type, thread_count (see thread_budget) and prune_iterations are passed to objective
+    """
+    thread_count = thread_budget(thread_count, n_jobs, fold_jobs)
+    fold_executor = None
+    pools_dir = None
+    if fold_jobs > 1:
+        # workers sharing work_dir can have the same pid on different nodes
+        pools_dir = tempfile.mkdtemp(prefix="fold_pools_", dir=work_dir)
+        save_pools(pools, pools_dir)
+        # spawn, CatBoost isn't fork safe once it has started threads
+        fold_executor = ProcessPoolExecutor(max_workers=fold_jobs, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        study.optimize(lambda trial: objective(trial, pools, task_type, thread_count, prune_iterations,
+                                               fold_executor, pools_dir, iterations),
+                       n_trials=n_trials, n_jobs=n_jobs, callbacks=callbacks)
+    finally:
+        if fold_executor is not None:
+            fold_executor.shutdown()
+            shutil.rmtree(pools_dir)
+
+
+def enqueue_promoted(study, promoted, n_trials):
+    """
+    This method enqueues the best configurations of a fidelity stage, so study only evaluates promoted configurations
+    :param study: study of the next stage or the full study
+    :type study: optuna.Study
+    :param promoted: parameters of completed trials, best first, see run_fidelity_stages
+    :type promoted: list
+    :param n_trials: number of configurations to promote
+    :type n_trials: int
+    :return: number of enqueued configurations, at most n_trials
+    :rtype: int
+    """
+    n_trials = min(n_trials, len(promoted))
+    for params in promoted[:n_trials]:
+        study.enqueue_trial(params)
+    return n_trials
+
+
+def run_fidelity_stages(stages, X, y, study_name, storage_name, sampler, pruner, output_dir, kfold=5, n_jobs=1,
+                        fold_jobs=1, task_type="GPU", thread_count=-1, prune_iterations=False):
+    """
+    This method runs the low fidelity stages of a multi-fidelity search, each as the study
+    <study_name>_fidelity_<i> in the same storage. The first stage samples its configurations, every later stage
+    evaluates the best configurations of the stage before
+    :param stages: stages parsed by fidelity_stage
+    :type stages: list
+    :param kfold: number of folds of stages that don't set KFOLD
+    :type kfold: int
+    :param n_jobs, fold_jobs, task_type, thread_count, prune_iterations: see run_trials
+    :return: parameters of the completed trials of the last stage, best first
+    :rtype: list
+    """
+    promoted = None
+    for i, stage in enumerate(stages):
+        stage_name = "{}_fidelity_{}".format(study_name, i)
+        if stage_name in optuna.get_all_study_names(storage_name):
+            optuna.delete_study(study_name=stage_name, storage=storage_name)
+        study = optuna.create_study(direction="maximize", study_name=stage_name, storage=storage_name,
+                                    sampler=sampler, pruner=pruner)
+        n_trials = stage['n_trials']
+        if promoted is not None:
+            n_trials = enqueue_promoted(study, promoted, n_trials)
+        stage_dir = os.path.join(output_dir, stage_name)
+        Path(stage_dir).mkdir(exist_ok=True)
+        positions = stratified_subsample(y, stage['fraction'])
+        X_stage, y_stage = X.iloc[positions], y.iloc[positions]
+        pools = build_pools(X_stage, y_stage, make_folds(y_stage, stage['kfold'] or kfold), stage_dir, task_type)
+        del X_stage, y_stage
+        print("Fidelity stage {}: {} trials on {} rows with {} iterations".format(i, n_trials, len(positions),
+                                                                                  stage['iterations']))
+        run_trials(study, pools, stage_dir, n_trials, n_jobs, fold_jobs=fold_jobs, iterations=stage['iterations'],
+                   task_type=task_type, thread_count=thread_count, prune_iterations=prune_iterations)
+        completed = [trial for trial in study.trials if trial.state == optuna.trial.TrialState.COMPLETE]
+        promoted = [trial.params for trial in sorted(completed, key=lambda trial: trial.value, reverse=True)]
+    return promoted
+
+
+def ke_optuna(study_name, sampler, n_trials, output_dir, input_file, kfold=5, resume=False, storage_name=None,
+              n_jobs=1, worker=False, pruner="none", fold_jobs=1, fidelity=(), task_type="GPU", thread_count=-1,
+              prune_iterations=False):
     # select sampler
     if sampler == "RandomSampler":
         optuna_sampler = optuna.samplers.RandomSampler()
@@ -82,30 +410,56 @@ def ke_optuna(study_name, sampler, n_trials, output_dir):
         optuna_sampler = optuna.samplers.TPESampler()
     elif sampler == "CmaEsSampler":
         optuna_sampler = optuna.samplers.CmaEsSampler()
+    optuna_pruner = PRUNERS[pruner]()
 
     os.chdir(output_dir)
-    storage_name = "sqlite:///{}.db".format(study_name)
-    if args.resume:
+    if storage_name is None:
+        storage_name = "sqlite:///{}.db".format(study_name)
+    callbacks = []
+    if worker:
+        # every worker stops once the shared study has n_trials trials
+        study = optuna.create_study(direction="maximize", study_name=study_name, storage=storage_name, load_if_exists=True,
+                                    sampler=optuna_sampler, pruner=optuna_pruner)
+        if len(study.trials) >= n_trials:
+            print("Study has {} trials, the optimization is done.".format(len(study.trials)))
+            return
+        callbacks.append(optuna.study.MaxTrialsCallback(n_trials, states=None))
+    elif resume:
         # resume from existing study
         print("Loading previous study...")
         study = optuna.create_study(direction="maximize", study_name=study_name, storage=storage_name, load_if_exists=True,
-                                    sampler=optuna_sampler)
+                                    sampler=optuna_sampler, pruner=optuna_pruner)
         print("Loading finished.")
-        if len(study.trials) < args.trial_number:
-            n_trials = args.trial_number - len(study.trials)
+        if len(study.trials) < n_trials:
+            n_trials = n_trials - len(study.trials)
             print("Loaded study has completed {} trials, will continue another {} trials ".format(len(study.trials),
                                                                                                   n_trials))
 
         else:
-            print("Loaded study has completed all {} trials, the optimization is done.".format(args.trial_number))
+            print("Loaded study has completed all {} trials, the optimization is done.".format(n_trials))
             return
     else:
-        if os.path.exists("{}.db".format(study_name)):
-            os.remove("{}.db".format(study_name))
+        if study_name in optuna.get_all_study_names(storage_name):
+            optuna.delete_study(study_name=study_name, storage=storage_name)
         # create a new study
-        study = optuna.create_study(direction="maximize", study_name=study_name, storage=storage_name, sampler=optuna_sampler)
+        study = optuna.create_study(direction="maximize", study_name=study_name, storage=storage_name,
+                                    sampler=optuna_sampler, pruner=optuna_pruner)
 
-    study.optimize(objective, n_trials=n_trials)
+    X, y = load_data(input_file)
+    if fidelity:
+        promoted = run_fidelity_stages(fidelity, X, y, study_name, storage_name, optuna_sampler, optuna_pruner,
+                                       output_dir, kfold, n_jobs, fold_jobs, task_type, thread_count,
+                                       prune_iterations)
+        # only promoted configurations reach the full data
+        n_trials = enqueue_promoted(study, promoted, n_trials)
+        if n_trials == 0:
+            print("No trial of the last fidelity stage completed, nothing to promote to the full study.")
+            return
+    # split the folds and quantize the pools once for all trials
+    pools = build_pools(X, y, make_folds(y, kfold), output_dir, task_type)
+    del X, y
+    run_trials(study, pools, output_dir, n_trials, n_jobs, callbacks, fold_jobs, task_type=task_type,
+               thread_count=thread_count, prune_iterations=prune_iterations)
 
     # save best params to json file
     with open(os.path.join(output_dir, 'best_params.json'), 'w') as fp:
@@ -123,6 +477,16 @@ def ke_optuna(study_name, sampler, n_trials, output_dir):
 
 
 if __name__ == "__main__":
-    output_dir = os.path.join(args.output_folder, "{}_output/".format(args.study_name))
+    args = parser.parse_args()
+    if args.prune_iterations and args.task_type == "GPU":
+        parser.error("--prune_iterations needs --task_type CPU")
+    if args.prune_iterations and args.fold_jobs > 1:
+        parser.error("--prune_iterations can't be used with --fold_jobs")
+    if args.fidelity and (args.resume or args.worker):
+        parser.error("--fidelity only runs with a new study, not with --resume or --worker")
+    output_dir = os.path.abspath(os.path.join(args.output_folder, "{}_output/".format(args.study_name)))
     Path(output_dir).mkdir(parents=True, exist_ok=True)
-    ke_optuna(args.study_name, args.sampler, args.trial_number, output_dir)
\ No newline at end of file
+    ke_optuna(args.study_name, args.sampler, args.trial_number, output_dir, os.path.abspath(args.input_file),
+              kfold=args.kfold, resume=args.resume, storage_name=args.storage, n_jobs=args.n_jobs,
+              worker=args.worker, pruner=args.pruner, fold_jobs=args.fold_jobs, fidelity=args.fidelity,
+              task_type=args.task_type, thread_count=args.thread_count, prune_iterations=args.prune_iterations)
\ No newline at end of file
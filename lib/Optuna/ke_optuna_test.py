@@ -0,0 +1,162 @@
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+import numpy as np
+import optuna
+import pandas as pd
+from sklearn.model_selection import StratifiedKFold
+from sklearn.model_selection import train_test_split
+
+from . import ke_optuna as ko
+
+
+def labelled_features(n_rows=120):
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.integers(0, 20, (n_rows, 4)), columns=['go1', 'go2', 'taxa1', 'taxa2'],
+                     index=['SRRid%d' % i for i in range(n_rows)])
+    y = pd.Series(rng.choice(['root:Mixed', 'root:Engineered', 'root:Host-associated'], n_rows, p=[0.5, 0.3, 0.2]),
+                  index=X.index, name='biome')
+    return X, y
+
+
+class MyTestCase(unittest.TestCase):
+    def test_make_folds(self):
+        X, y = labelled_features()
+        folds = ko.make_folds(y, 5)
+        self.assertEqual(len(folds), 5)
+        # same rows as the per-trial split objective used to do
+        for (train, val, test), (train_val, old_test) in zip(folds, StratifiedKFold(n_splits=5).split(X, y)):
+            X_train, X_val, _, _ = train_test_split(X.iloc[train_val], y.iloc[train_val], random_state=42,
+                                                    test_size=0.22, stratify=y.iloc[train_val])
+            self.assertTrue(X.iloc[train].equals(X_train))
+            self.assertTrue(X.iloc[val].equals(X_val))
+            self.assertTrue(np.array_equal(test, old_test))
+
+    def test_objective_fold_jobs(self):
+        X, y = labelled_features()
+        params = {'depth': 4, 'learning_rate': 0.1, 'l2_leaf_reg': 2, 'random_strength': 1, 'bagging_temperature': 0}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pools = ko.build_pools(X, y, ko.make_folds(y, 3), tmp_dir, task_type="CPU")
+            serial = ko.objective(optuna.trial.FixedTrial(params), pools, "CPU", 1, iterations=20)
+            ko.save_pools(pools, tmp_dir)
+            with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn")) as executor:
+                parallel = ko.objective(optuna.trial.FixedTrial(params), pools, "CPU", 1, fold_executor=executor,
+                                        pools_dir=tmp_dir, iterations=20)
+        self.assertAlmostEqual(serial, parallel)
+
+    def test_objective_pruning(self):
+        X, y = labelled_features()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pools = ko.build_pools(X, y, ko.make_folds(y, 3), tmp_dir, task_type="CPU")
+            # the mean accuracy of the finished folds is reported after every fold
+            study = optuna.create_study(direction="maximize", pruner=ko.PRUNERS["median"]())
+            trial = study.ask()
+            value = ko.objective(trial, pools, "CPU", 1, iterations=20)
+            intermediate_values = study.trials[0].intermediate_values
+            self.assertEqual(list(intermediate_values), [0, 1, 2])
+            self.assertAlmostEqual(intermediate_values[2], value)
+
+            # every reported value is below the threshold, so the trial is pruned after the first fold
+            study = optuna.create_study(direction="maximize", pruner=optuna.pruners.ThresholdPruner(lower=1.1))
+            with self.assertRaises(optuna.TrialPruned):
+                ko.objective(study.ask(), pools, "CPU", 1, iterations=20)
+            self.assertEqual(list(study.trials[0].intermediate_values), [0])
+
+            # the remaining folds of the trial are cancelled
+            ko.save_pools(pools, tmp_dir)
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                with self.assertRaises(optuna.TrialPruned):
+                    ko.objective(study.ask(), pools, "CPU", 1, fold_executor=executor, pools_dir=tmp_dir,
+                                 iterations=20)
+            self.assertEqual(list(study.trials[1].intermediate_values), [0])
+
+            # with prune_iterations, every iteration is reported and training stops inside the first fold
+            with self.assertRaises(optuna.TrialPruned):
+                ko.objective(study.ask(), pools, "CPU", 1, prune_iterations=True, iterations=20)
+            self.assertEqual(list(study.trials[2].intermediate_values), [0])
+
+    def test_pruners(self):
+        self.assertEqual(list(ko.PRUNERS), ["none", "median", "successive_halving", "hyperband"])
+        for name, pruner in ko.PRUNERS.items():
+            with self.subTest(name):
+                self.assertIsInstance(pruner(), optuna.pruners.BasePruner)
+
+    def test_thread_budget(self):
+        with mock.patch.object(ko.os, 'cpu_count', return_value=16):
+            self.assertEqual(ko.thread_budget(-1), -1)
+            self.assertEqual(ko.thread_budget(-1, fold_jobs=4), 4)
+            # the concurrent trials share the fold processes
+            self.assertEqual(ko.thread_budget(-1, n_jobs=2, fold_jobs=4), 4)
+            self.assertEqual(ko.thread_budget(-1, fold_jobs=32), 1)
+            self.assertEqual(ko.thread_budget(-1, n_jobs=4), 4)
+            self.assertEqual(ko.thread_budget(-1, n_jobs=32), 1)
+            self.assertEqual(ko.thread_budget(3, n_jobs=2, fold_jobs=4), 3)
+
+    def test_ke_optuna_workers(self):
+        X, y = labelled_features()
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = os.path.join(tmp_dir, 'dataset.pkl')
+            pd.concat([y, X], axis=1).to_pickle(input_file)
+            storage_name = "sqlite:///" + os.path.join(tmp_dir, 'shared.db')
+
+            def worker(n_trials):
+                ko.ke_optuna("workers", "RandomSampler", n_trials, tmp_dir, input_file, kfold=2,
+                             storage_name=storage_name, worker=True, task_type="CPU", thread_count=1)
+
+            with mock.patch.object(ko, 'plot_parallel_coordinate'), mock.patch.object(ko, 'plot_contour'):
+                # two workers share the study and stop once it has 4 trials, a trial still running in the other
+                # worker can finish after the limit
+                threads = [threading.Thread(target=worker, args=(4,)) for _ in range(2)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                n_trials = len(optuna.load_study(study_name="workers", storage=storage_name).trials)
+                self.assertIn(n_trials, [4, 5])
+                # a worker attaches to the finished study without running trials
+                worker(4)
+                self.assertEqual(len(optuna.load_study(study_name="workers", storage=storage_name).trials), n_trials)
+                # and continues it up to a larger trial number
+                worker(n_trials + 1)
+                self.assertEqual(len(optuna.load_study(study_name="workers", storage=storage_name).trials),
+                                 n_trials + 1)
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'best_params.json')))
+
+    def test_fidelity_stage(self):
+        self.assertEqual(ko.fidelity_stage("0.1:200:100:2"),
+                         {'fraction': 0.1, 'iterations': 200, 'n_trials': 100, 'kfold': 2})
+        self.assertEqual(ko.fidelity_stage("1:500:30"),
+                         {'fraction': 1.0, 'iterations': 500, 'n_trials': 30, 'kfold': None})
+        for stage in ["0.1:200", "0.1:200:100:2:1", "a:200:100", "0.1:2.5:100", "0:200:100", "1.5:200:100",
+                      "0.1:0:100", "0.1:200:0"]:
+            with self.subTest(stage), self.assertRaises(argparse.ArgumentTypeError):
+                ko.fidelity_stage(stage)
+
+    def test_stratified_subsample(self):
+        _, y = labelled_features(1000)
+        positions = ko.stratified_subsample(y, 0.2)
+        self.assertEqual(len(positions), 200)
+        self.assertTrue(np.array_equal(positions, np.unique(positions)))
+        pd.testing.assert_series_equal(y.iloc[positions].value_counts(normalize=True), y.value_counts(normalize=True),
+                                       atol=0.01)
+        self.assertTrue(np.array_equal(ko.stratified_subsample(y, 1), np.arange(1000)))
+
+    def test_enqueue_promoted(self):
+        promoted = [{'depth': depth} for depth in [6, 4, 8]]
+        study = optuna.create_study(direction="maximize")
+        self.assertEqual(ko.enqueue_promoted(study, promoted, 2), 2)
+        self.assertEqual(ko.enqueue_promoted(optuna.create_study(direction="maximize"), promoted, 10), 3)
+        self.assertEqual(ko.enqueue_promoted(optuna.create_study(direction="maximize"), [], 10), 0)
+        self.assertEqual(len(study.get_trials(states=(optuna.trial.TrialState.WAITING,))), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
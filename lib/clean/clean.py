@@ -1,38 +1,82 @@
 import collections
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
 
-def rows_and_cols_quant_filter(data, start_col_index=1, cutoff=0, pandas=True):
+def quant_filter_masks(values, cutoff=0):
+    """
+    This method finds rows whose abundance sum is above the cutoff, then columns whose sum over those rows is above
+    the cutoff. NaN values count as 0. values is not modified, sparse values are copied only if they hold NaN.
+    :param values: numerical data
+    :type values: numpy array or scipy sparse matrix
+    :param cutoff: rows and cols whose sum is below or equal the cutoff are removed
+    :type cutoff: number
+    :return: row mask and col mask, True means kept
+    :rtype: numpy array, numpy array
+    """
+    # NaN counts as 0 like the pandas sums of the original filter
+    if sparse.issparse(values):
+        if values.dtype.kind == 'f' and np.isnan(values.data).any():
+            values = values.copy()
+            values.data[np.isnan(values.data)] = 0
+        row_mask = np.asarray(values.sum(axis=1)).ravel() > cutoff
+        _check_not_empty(row_mask, "rows'")
+        col_sum = values[row_mask].sum(axis=0)
+    else:
+        not_nan = _not_nan(values)
+        row_mask = values.sum(axis=1, where=not_nan) > cutoff
+        _check_not_empty(row_mask, "rows'")
+        # column sums over kept rows only. sum() accumulates compact integer dtypes in a wide type, so no overflow
+        col_sum = values.sum(axis=0, where=not_nan & row_mask[:, None])
+    col_mask = np.asarray(col_sum).ravel() > cutoff
+    _check_not_empty(col_mask, "cols'")
+    return row_mask, col_mask
+
+
+def _not_nan(values):
+    """
+    :return: mask of the values that aren't NaN, True if values can't hold NaN
+    :rtype: numpy array or bool
+    """
+    if values.dtype.kind in 'fc':
+        return ~np.isnan(values)
+    return True
+
+
+def _check_not_empty(mask, name):
+    if not mask.any():
+        raise ValueError(
+            "cutoff is greater than all {} sum, data will be empty after filtering. "
+            "Please choose a smaller cutoff value.".format(name))
+
+
+def rows_and_cols_quant_filter(data, start_col_index=1, cutoff=0, pandas=True, return_masks=False):
     """
     This method removes rows and cols whose abundance sum is below or equal the cutoff value.
-    data: a pandas dataframework or numpy array
+    data is not modified and abundance dtypes are kept, compact dtypes (see transform.dtypes) stay compact.
+    data: a pandas dataframework (pandas=True), or a numpy array or scipy sparse matrix (pandas=False)
     start_col_index: the index of the first column to start with
+    return_masks: if True, return row mask and col mask (covering all columns of data) instead of filtered data
     return: data after filtering
     """
     if pandas:
-        df = data
-        df['row sum'] = df.iloc[:, start_col_index:].sum(axis=1)
-        if df['row sum'].max() <= cutoff:
-            raise ValueError(
-                "cutoff is greater than all rows' sum, data will be empty after filtering. "
-                "Please choose a smaller cutoff value.")
-
-        row_filtered_df = df.loc[df['row sum'] > cutoff]
-        #         print(row_filtered_df)
-        numerical_df = row_filtered_df.iloc[:, start_col_index:]
-        numerical_df.loc['col sum', :] = numerical_df.sum(axis=0)
-        if max(numerical_df.loc['col sum'].values[start_col_index:-1]) <= cutoff:
-            raise ValueError(
-                "cutoff is greater than all cols' sum, data will be empty after filtering. "
-                "Please choose a smaller cutoff value.")
-
-        numerical_df_col_filtered = numerical_df.loc[:, numerical_df.loc['col sum'].values > cutoff]
-        numerical_df_col_filtered.drop(labels='col sum', axis=0, inplace=True)
-        numerical_df_col_filtered.drop(labels='row sum', axis=1, inplace=True)
-        res = pd.concat([row_filtered_df.iloc[:, :start_col_index], numerical_df_col_filtered], axis=1)
+        values = data.iloc[:, start_col_index:].to_numpy()
+    elif start_col_index == 0:
+        values = data
     else:
-        pass
+        values = data[:, start_col_index:]
+    row_mask, col_mask = quant_filter_masks(values, cutoff)
+    col_mask = np.concatenate([np.ones(start_col_index, dtype=bool), col_mask])
+    if return_masks:
+        return row_mask, col_mask
+    if pandas:
+        res = data.loc[row_mask, col_mask]
+    elif sparse.issparse(data):
+        res = data[row_mask][:, col_mask]
+    else:
+        res = data[np.ix_(row_mask, col_mask)]
     return res
 
 
@@ -52,3 +96,113 @@ def remove_low_freq(df, target, threshold):
     low_freq_list = [item[0] for item in counter if item[1] < threshold]
     high_freq_df = df.loc[~df[target].isin(low_freq_list)]
     return high_freq_df
+
+
+def scan_file(input_file, start_col_index=1, cutoff=None, target=None, chunksize=10000):
+    """
+    This method is the first pass of the chunked filters. It streams a tsv table chunksize rows at a time and
+    collects row sums, presence counts (number of values > 0 per row), col sums and labels. NaN values count as 0
+    :param input_file: tsv table, abundance columns start at start_col_index
+    :type input_file: string
+    :param start_col_index: the index of the first abundance column
+    :type start_col_index: int
+    :param cutoff: if given, col sums and label counts only include rows whose sum is above cutoff
+    :type cutoff: number
+    :param target: the label column name to collect
+    :type target: string
+    :param chunksize: number of rows parsed at a time
+    :type chunksize: int
+    :return: {'columns': list, 'row_sum': array, 'presence': array, 'row_mask': array, 'col_sum': array,
+              'labels': array (if target), 'label_count': Counter (if target)}
+    :rtype: dict
+    """
+    columns = list(pd.read_csv(input_file, sep="\t", nrows=0).columns)
+    row_sum, presence, labels = [], [], []
+    col_sum = np.zeros(len(columns) - start_col_index)
+    for chunk in pd.read_csv(input_file, sep="\t", chunksize=chunksize):
+        values = chunk.iloc[:, start_col_index:].to_numpy()
+        # NaN counts as 0, see quant_filter_masks
+        not_nan = _not_nan(values)
+        chunk_row_sum = values.sum(axis=1, where=not_nan)
+        kept = chunk_row_sum > cutoff if cutoff is not None else np.ones(len(chunk), dtype=bool)
+        col_sum += values.sum(axis=0, where=not_nan & kept[:, None])
+        row_sum.append(chunk_row_sum)
+        presence.append((values > 0).sum(axis=1))
+        if target is not None:
+            labels.append(chunk[target].to_numpy())
+    res = {'columns': columns,
+           'row_sum': np.concatenate(row_sum) if row_sum else np.array([]),
+           'presence': np.concatenate(presence) if presence else np.array([], dtype=int),
+           'col_sum': col_sum}
+    res['row_mask'] = res['row_sum'] > cutoff if cutoff is not None else np.ones(len(res['row_sum']), dtype=bool)
+    if target is not None:
+        res['labels'] = np.concatenate(labels) if labels else np.array([])
+        res['label_count'] = collections.Counter(res['labels'][res['row_mask']])
+    return res
+
+
+def write_filtered_file(input_file, output_file, row_mask, col_mask, chunksize=10000):
+    """
+    This method is the second pass of the chunked filters. It streams a tsv table and writes only the kept rows
+    and cols
+    :param input_file: tsv table
+    :type input_file: string
+    :param output_file: output tsv path
+    :type output_file: string
+    :param row_mask: True means the row is kept
+    :type row_mask: numpy array
+    :param col_mask: True means the column is kept, covers all columns
+    :type col_mask: numpy array
+    :param chunksize: number of rows parsed at a time
+    :type chunksize: int
+    :return: None
+    """
+    columns = pd.read_csv(input_file, sep="\t", nrows=0).columns
+    with open(output_file, 'w') as f:
+        f.write("\t".join(columns[col_mask]) + "\n")
+        start = 0
+        for chunk in pd.read_csv(input_file, sep="\t", chunksize=chunksize):
+            chunk_mask = row_mask[start:start + len(chunk)]
+            chunk.loc[chunk_mask, col_mask].to_csv(f, sep="\t", header=False, index=False)
+            start += len(chunk)
+
+
+def filter_file_chunked(input_file, output_file, start_col_index=1, cutoff=None, target=None, threshold=None,
+                        chunksize=10000):
+    """
+    This method filters a tsv table too large to load in two streaming passes. The output is the same as
+    remove_low_freq(rows_and_cols_quant_filter(df, start_col_index, cutoff), target, threshold) written without
+    index. The quant filter is skipped if cutoff is None, the frequency filter if target and threshold are None,
+    they must be given together
+    :param input_file: tsv table, abundance columns start at start_col_index
+    :type input_file: string
+    :param output_file: output tsv path
+    :type output_file: string
+    :param start_col_index: the index of the first abundance column
+    :type start_col_index: int
+    :param cutoff: rows and cols whose abundance sum is below or equal the cutoff value are removed
+    :type cutoff: number
+    :param target: the label column name to count
+    :type target: string
+    :param threshold: labels whose frequency is below threshold are removed
+    :type threshold: int
+    :param chunksize: number of rows parsed at a time
+    :type chunksize: int
+    :return: row mask and col mask of the input table
+    :rtype: numpy array, numpy array
+    """
+    if (target is None) != (threshold is None):
+        raise ValueError("target and threshold must be given together, got target=%s and threshold=%s"
+                         % (target, threshold))
+    file_stats = scan_file(input_file, start_col_index, cutoff, target, chunksize)
+    row_mask = file_stats['row_mask']
+    col_mask = np.ones(len(file_stats['columns']), dtype=bool)
+    if cutoff is not None:
+        _check_not_empty(row_mask, "rows'")
+        _check_not_empty(file_stats['col_sum'] > cutoff, "cols'")
+        col_mask[start_col_index:] = file_stats['col_sum'] > cutoff
+    if target is not None:
+        low_freq_list = [label for label, count in file_stats['label_count'].items() if count < threshold]
+        row_mask = row_mask & ~np.isin(file_stats['labels'], low_freq_list)
+    write_filtered_file(input_file, output_file, row_mask, col_mask, chunksize)
+    return row_mask, col_mask
@@ -2,7 +2,9 @@ import unittest
 from clean import *
 import pandas as pd
 import numpy as np
+from scipy import sparse
 import os
+import tempfile
 
 
 class MyTestCase(unittest.TestCase):
@@ -16,6 +18,46 @@ class MyTestCase(unittest.TestCase):
         res = rows_and_cols_quant_filter(df_test, start_col_index=2, cutoff=4, pandas=True)
         self.assertTrue(df_ground_truth.reset_index(drop=True).equals(res.reset_index(drop=True)))
 
+    def test_rows_and_cols_quant_filter_array(self):
+        test_file = os.path.join(self.data_dir, 'test.tsv')
+        ground_truth_file = os.path.join(self.data_dir, 'ground_truth.tsv')
+        df_test = pd.read_csv(test_file, sep="\t")
+        df_ground_truth = pd.read_csv(ground_truth_file, sep="\t")
+        values = df_test.iloc[:, 2:].to_numpy()
+        res = rows_and_cols_quant_filter(values, start_col_index=0, cutoff=4, pandas=False)
+        self.assertTrue(np.array_equal(res, df_ground_truth.iloc[:, 2:].to_numpy()))
+        res = rows_and_cols_quant_filter(sparse.csr_matrix(values), start_col_index=0, cutoff=4, pandas=False)
+        self.assertTrue(np.array_equal(res.toarray(), df_ground_truth.iloc[:, 2:].to_numpy()))
+        row_mask, col_mask = rows_and_cols_quant_filter(df_test, start_col_index=2, cutoff=4, return_masks=True)
+        self.assertEqual(list(row_mask), [True, True, False, True])
+        self.assertEqual(list(df_test.columns[col_mask]), list(df_ground_truth.columns))
+        # input is not modified
+        self.assertEqual(list(df_test.columns), ['id', 'type', 'col1', 'col2', 'col3', 'col4'])
+        with self.assertRaises(ValueError):
+            rows_and_cols_quant_filter(values, start_col_index=0, cutoff=100, pandas=False)
+        # sums of compact dtypes don't overflow
+        counts = np.full((256, 2), 255, dtype=np.uint8)
+        counts[:, 1] = 0
+        res = rows_and_cols_quant_filter(counts, start_col_index=0, cutoff=200, pandas=False)
+        self.assertEqual(res.shape, (256, 1))
+        self.assertEqual(res.dtype, np.uint8)
+
+    def test_rows_and_cols_quant_filter_nan(self):
+        # NaN counts as 0, like the pandas sums of the original filter
+        df = pd.DataFrame({'id': ['Tom', 'Kim', 'Mary', 'Lily'], 'col1': [np.nan, 0, 1, np.nan],
+                           'col2': [5, 0, np.nan, np.nan], 'col3': [np.nan, 2, 0, np.nan]})
+        row_mask, col_mask = rows_and_cols_quant_filter(df, cutoff=0, return_masks=True)
+        self.assertEqual(list(row_mask), [True, True, True, False])
+        self.assertEqual(list(col_mask), [True, True, True, True])
+        row_mask, col_mask = rows_and_cols_quant_filter(df, cutoff=1, return_masks=True)
+        self.assertEqual(list(row_mask), [True, True, False, False])
+        self.assertEqual(list(col_mask), [True, False, True, True])
+        values = df.iloc[:, 1:].to_numpy()
+        res = rows_and_cols_quant_filter(sparse.csr_matrix(values), start_col_index=0, cutoff=1, pandas=False)
+        np.testing.assert_array_equal(res.toarray(), values[:2, 1:])
+        np.testing.assert_array_equal(rows_and_cols_quant_filter(values, start_col_index=0, cutoff=1, pandas=False),
+                                      values[:2, 1:])
+
     def test_remove_low_freq(self):
         test_file = os.path.join(self.data_dir, 'test.tsv')
         df_test = pd.read_csv(test_file, sep="\t")
@@ -25,5 +67,40 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(len(filtered_df_2.index), 0)
 
 
+    def test_filter_file_chunked(self):
+        test_file = os.path.join(self.data_dir, 'test.tsv')
+        df_test = pd.read_csv(test_file, sep="\t")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file = os.path.join(tmp_dir, 'test_chunked.tsv')
+            filter_file_chunked(test_file, output_file, start_col_index=2, cutoff=4, chunksize=1)
+            res = rows_and_cols_quant_filter(df_test, start_col_index=2, cutoff=4)
+            self.assertTrue(pd.read_csv(output_file, sep="\t").equals(res.reset_index(drop=True)))
+
+            filter_file_chunked(test_file, output_file, start_col_index=2, target='type', threshold=2, chunksize=3)
+            res = remove_low_freq(df_test, 'type', 2)
+            self.assertTrue(pd.read_csv(output_file, sep="\t").equals(res.reset_index(drop=True)))
+
+            filter_file_chunked(test_file, output_file, start_col_index=2, cutoff=0, target='type', threshold=2)
+            res = remove_low_freq(rows_and_cols_quant_filter(df_test, start_col_index=2, cutoff=0), 'type', 2)
+            self.assertTrue(pd.read_csv(output_file, sep="\t").equals(res.reset_index(drop=True)))
+
+            # NaN counts as 0 in every chunk, like in the in-memory filter
+            nan_file = os.path.join(tmp_dir, 'test_nan.tsv')
+            df_nan = df_test.astype({'col1': float, 'col2': float})
+            df_nan.loc[0, 'col2'] = np.nan
+            df_nan.loc[3, 'col1'] = np.nan
+            df_nan.to_csv(nan_file, sep="\t", index=False)
+            row_mask, col_mask = filter_file_chunked(nan_file, output_file, start_col_index=2, cutoff=1, chunksize=2)
+            self.assertEqual(list(row_mask), [True, True, False, True])
+            res = rows_and_cols_quant_filter(df_nan, start_col_index=2, cutoff=1)
+            self.assertTrue(pd.read_csv(output_file, sep="\t").equals(res.reset_index(drop=True)))
+
+            output_file = os.path.join(tmp_dir, 'test_invalid.tsv')
+            with self.assertRaises(ValueError):
+                filter_file_chunked(test_file, output_file, start_col_index=2, target='type')
+            with self.assertRaises(ValueError):
+                filter_file_chunked(test_file, output_file, start_col_index=2, threshold=2)
+            self.assertFalse(os.path.exists(output_file))
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,43 +1,225 @@
 import collections
+import json
 from pathlib import Path
 
 import category_encoders as ce
+import joblib
+import numpy as np
+import pandas as pd
 from imblearn.over_sampling import RandomOverSampler
 from imblearn.under_sampling import RandomUnderSampler
 from sklearn import preprocessing
 from sklearn.model_selection import train_test_split
 
+from ..transform import dtypes
 
-def dataset_split(df, train=0.7, val=0.2, test=0.1):
-    df_train, df_rest = train_test_split(df, train_size=train, random_state=42, stratify=df['biome'])
-    assert set(df_train['biome']) == set(df_rest['biome'])
+
+def load_dataset(path, first_numerical_col_idx=2):
+    """
+    This method loads an aggregated dataset and casts its abundance columns to one compact dtype
+    (see transform.dtypes), e.g. uint16 instead of int64 for raw counts
+    :param path: dataset path, a .pkl, .parquet or tsv file
+    :type path: string
+    :param first_numerical_col_idx: the index of the first abundance column, non-numeric columns after it such as
+                                    'biome' are kept as they are
+    :type first_numerical_col_idx: int
+    :return: dataset
+    :rtype: pandas dataframe
+    """
+    if path.endswith('.pkl'):
+        df = pd.read_pickle(path)
+    elif path.endswith('.parquet'):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path, sep='\t')
+    return dtypes.compact_columns(df, first_numerical_col_idx)
+
+
+def split_indices(df, train=0.7, val=0.2, test=0.1, seed=42, stratify='biome'):
+    """
+    This method splits row positions of df into stratified train, validation and test sets.
+    Selecting the rows of df at these positions gives the same sets as dataset_split with the same seed
+    :param df: data
+    :type df: pandas dataframe
+    :param train: train fraction
+    :type train: float
+    :param val: validation fraction
+    :type val: float
+    :param test: test fraction
+    :type test: float
+    :param seed: random state of both splits
+    :type seed: int
+    :param stratify: label column the splits are stratified by
+    :type stratify: string
+    :return: {'train': positions, 'val': positions, 'test': positions}
+    :rtype: dict
+    """
+    positions = np.arange(len(df))
+    labels = df[stratify].to_numpy()
+    train_pos, rest_pos = train_test_split(positions, train_size=train, random_state=seed, stratify=labels)
+    assert set(labels[train_pos]) == set(labels[rest_pos])
     val_test_ratio = val/(val+test)
-    df_val, df_test = train_test_split(df_rest, train_size=val_test_ratio, random_state=42, stratify=df_rest['biome'])
-    assert set(df_train['biome']) == set(df_val['biome']) == set(df_test['biome'])
+    val_pos, test_pos = train_test_split(rest_pos, train_size=val_test_ratio, random_state=seed,
+                                         stratify=labels[rest_pos])
+    assert set(labels[train_pos]) == set(labels[val_pos]) == set(labels[test_pos])
+    return {'train': train_pos, 'val': val_pos, 'test': test_pos}
+
+
+def dataset_split(df, train=0.7, val=0.2, test=0.1, index_only=False, dataset_path=None, seed=42,
+                  output_dir="splitted_dataset", first_numerical_col_idx=5):
+    """
+    This method splits data into stratified train, validation and test sets and saves them in output_dir
+    :param df: data, with a 'biome' label column
+    :type df: pandas dataframe
+    :param train: train fraction
+    :type train: float
+    :param val: validation fraction
+    :type val: float
+    :param test: test fraction
+    :type test: float
+    :param index_only: if true, only a manifest of row positions per split is saved to
+                       output_dir/split_manifest.json, load the splits with load_split
+    :type index_only: boolean
+    :param dataset_path: path of the dataset df was loaded from, recorded in the manifest so load_split can read it
+    :type dataset_path: string
+    :param seed: random state of the splits
+    :type seed: int
+    :param output_dir: output directory
+    :type output_dir: string
+    :param first_numerical_col_idx: the index of the first feature column, recorded in the manifest so load_split
+                                    loads the dataset with it. 5 in the labelled table
+                                    (id, study_id, sample_id, biome, exptype, features)
+    :type first_numerical_col_idx: int
+    :return: train, validation and test sets, or the manifest if index_only
+    :rtype: pandas dataframes or dict
+    """
+    positions = split_indices(df, train, val, test, seed=seed)
+    Path(output_dir).mkdir(exist_ok=True)
+    if index_only:
+        manifest = {'dataset': dataset_path, 'first_numerical_col_idx': first_numerical_col_idx,
+                    'n_rows': len(df), 'seed': seed, 'stratify': 'biome',
+                    'fractions': {'train': train, 'val': val, 'test': test},
+                    'positions': {split: pos.tolist() for split, pos in positions.items()}}
+        if 'id' in df.columns:
+            manifest['ids'] = {split: df['id'].iloc[pos].astype(str).tolist() for split, pos in positions.items()}
+        with open(Path(output_dir) / 'split_manifest.json', 'w') as f:
+            json.dump(manifest, f)
+        return manifest
+    df_train, df_val, df_test = (df.iloc[positions[split]] for split in ['train', 'val', 'test'])
     # save dataset
-    Path("splitted_dataset").mkdir(exist_ok=True)
-    Path("splitted_dataset/train_set").mkdir(exist_ok=True)
-    df_train.to_csv('splitted_dataset/train_set/train_set.tsv', sep="\t", index=False)
-    df_train.to_pickle('splitted_dataset/train_set/test_set.pkl')
-    Path("splitted_dataset/val_set").mkdir(exist_ok=True)
-    df_val.to_csv('splitted_dataset/val_set/test_set.tsv', sep="\t", index=False)
-    df_val.to_pickle('splitted_dataset/val_set/test_set.pkl')
-    Path("splitted_dataset/test_set").mkdir(exist_ok=True)
-    df_test.to_csv('splitted_dataset/test_set/test_set.tsv', sep="\t", index=False)
-    df_test.to_pickle('splitted_dataset/test_set/test_set.pkl')
+    Path(output_dir, "train_set").mkdir(exist_ok=True)
+    df_train.to_csv(Path(output_dir, 'train_set/train_set.tsv'), sep="\t", index=False)
+    df_train.to_pickle(Path(output_dir, 'train_set/train_set.pkl'))
+    Path(output_dir, "val_set").mkdir(exist_ok=True)
+    df_val.to_csv(Path(output_dir, 'val_set/test_set.tsv'), sep="\t", index=False)
+    df_val.to_pickle(Path(output_dir, 'val_set/test_set.pkl'))
+    Path(output_dir, "test_set").mkdir(exist_ok=True)
+    df_test.to_csv(Path(output_dir, 'test_set/test_set.tsv'), sep="\t", index=False)
+    df_test.to_pickle(Path(output_dir, 'test_set/test_set.pkl'))
     return df_train, df_val, df_test
 
 
-def dataset_balancing(df, each_class_count):
+def load_split(manifest_path, split, df=None, first_numerical_col_idx=None):
+    """
+    This method materializes one split of an index only dataset_split by selecting its rows from the dataset
+    :param manifest_path: path of split_manifest.json
+    :type manifest_path: string
+    :param split: 'train', 'val' or 'test'
+    :type split: string
+    :param df: the dataset the manifest was made from. If None, it is loaded from the path recorded in the manifest
+    :type df: pandas dataframe
+    :param first_numerical_col_idx: the index of the first feature column when loading the dataset,
+                                    None takes it from the manifest
+    :type first_numerical_col_idx: int
+    :return: the rows of the split
+    :rtype: pandas dataframe
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if split not in manifest['positions']:
+        raise ValueError("split should be one of %s, got %s" % (list(manifest['positions']), split))
+    if df is None:
+        if manifest['dataset'] is None:
+            raise ValueError("%s doesn't record a dataset path, pass the dataset as df" % manifest_path)
+        if first_numerical_col_idx is None:
+            first_numerical_col_idx = manifest['first_numerical_col_idx']
+        df = load_dataset(manifest['dataset'], first_numerical_col_idx)
+    if len(df) != manifest['n_rows']:
+        raise ValueError("dataset has %d rows, the manifest was made from %d" % (len(df), manifest['n_rows']))
+    df_split = df.iloc[manifest['positions'][split]]
+    if 'ids' in manifest and df_split['id'].astype(str).tolist() != manifest['ids'][split]:
+        raise ValueError("dataset rows don't match the manifest ids")
+    return df_split
+
+
+def balanced_indices(y, each_class_count, seed=None):
+    """
+    This method samples row positions so that every label has the same number of rows, without copying features.
+    Like dataset_balancing, labels with more than each_class_count rows are downsampled without replacement,
+    then the other labels are upsampled with replacement to the size of the largest label
+    :param y: label of every row
+    :type y: array like
+    :param each_class_count: how many data samples of each label at most
+    :type each_class_count: int
+    :param seed: random state, same seed gives the same positions
+    :type seed: int
+    :return: row positions grouped by label, upsampled positions repeat
+    :rtype: numpy array
+    """
+    y = np.asarray(y)
+    random_state = np.random.RandomState(seed)
+    labels, counts = np.unique(y, return_counts=True)
+    target = min(counts.max(), each_class_count)
+    indices = []
+    for label in labels:
+        positions = np.flatnonzero(y == label)
+        if len(positions) > target:
+            positions = np.sort(random_state.choice(positions, target, replace=False))
+        elif len(positions) < target:
+            positions = np.concatenate([positions, random_state.choice(positions, target - len(positions))])
+        indices.append(positions)
+    return np.concatenate(indices)
+
+
+def balanced_weights(y, each_class_count):
+    """
+    This method computes sample weights that balance labels the way dataset_balancing does, every label
+    gets a total weight equal to the number of rows it would have after balancing
+    :param y: label of every row
+    :type y: array like
+    :param each_class_count: how many data samples of each label at most
+    :type each_class_count: int
+    :return: weight of every row
+    :rtype: numpy array
+    """
+    y = np.asarray(y)
+    labels, inverse, counts = np.unique(y, return_inverse=True, return_counts=True)
+    target = min(counts.max(), each_class_count)
+    return (target / counts)[inverse]
+
+
+def dataset_balancing(df, each_class_count, mode="resample", seed=None):
     """
     This methods takes in pandas df
     :param df: data, first column is label and rest are features
     :type df: pandas dataframe work
     :param each_class_count: how many data samples of each label
     :type each_class_count: int
-    :return: new data after balancing
-    :rtype: pandas dataframe work
+    :param mode: "resample" returns the balanced data, "indices" only the sampled row positions
+                 (see balanced_indices) and "weights" a sample weight per row (see balanced_weights),
+                 so the features are never copied
+    :type mode: string
+    :param seed: random state of the samplers
+    :type seed: int
+    :return: new data after balancing, row positions or row weights
+    :rtype: pandas dataframe work or numpy array
     """
+    if mode == "indices":
+        return balanced_indices(df.iloc[:, 0], each_class_count, seed)
+    if mode == "weights":
+        return balanced_weights(df.iloc[:, 0], each_class_count)
+    if mode != "resample":
+        raise ValueError("mode should be one of ['resample', 'indices', 'weights'], got %s" % mode)
     X, y = df.iloc[:, 1:], df.iloc[:, 0]
     counter = collections.Counter(y).most_common()
     # create downsampling sampling_strategy map
@@ -46,23 +228,123 @@ def dataset_balancing(df, each_class_count):
         if count > each_class_count:
             downsampler_dict[label] = each_class_count
     # downsampling
-    under_sampler = RandomUnderSampler(sampling_strategy=downsampler_dict)
+    under_sampler = RandomUnderSampler(sampling_strategy=downsampler_dict, random_state=seed)
     X_undersampled, y_undersampled = under_sampler.fit_resample(X, y)
     # upsampling
-    over_sampler = RandomOverSampler(sampling_strategy='not majority')
+    over_sampler = RandomOverSampler(sampling_strategy='not majority', random_state=seed)
     X_oversampled, y_oversampled = over_sampler.fit_resample(X_undersampled, y_undersampled)
     X_oversampled.insert(0, 'biome', y_oversampled)
     return X_oversampled
 
 
-def normalization(df, method, first_numerical_col_idx=2):
+SCALERS = {"standard": preprocessing.StandardScaler, "minmax": preprocessing.MinMaxScaler}
+
+
+def fit_scaler(df, method, first_numerical_col_idx=2, chunksize=10000):
+    """
+    This method fits a scaler with partial_fit over chunksize rows at a time, so the numerical block is never
+    copied as a whole
+    :param df: data, numerical columns start at first_numerical_col_idx
+    :type df: pandas dataframe
+    :param method: "standard" or "minmax"
+    :type method: string
+    :param first_numerical_col_idx: the index of the first numerical column
+    :type first_numerical_col_idx: int
+    :param chunksize: number of rows per partial_fit call
+    :type chunksize: int
+    :return: fitted scaler
+    :rtype: sklearn StandardScaler or MinMaxScaler
+    """
+    if method not in SCALERS:
+        raise ValueError("method should be one of %s, got %s" % (list(SCALERS), method))
+    scaler = SCALERS[method]()
+    for start in range(0, len(df), chunksize):
+        scaler.partial_fit(df.iloc[start:start + chunksize, first_numerical_col_idx:].to_numpy())
+    return scaler
+
+
+def apply_scaler(df, scaler, first_numerical_col_idx=2, chunksize=10000):
+    """
+    This method normalizes the numerical columns in place, chunksize rows at a time. The numerical block is taken
+    once as a float32 array, transformed chunk by chunk and put back, so scaler temporaries stay chunk sized
+    :param df: data, numerical columns start at first_numerical_col_idx
+    :type df: pandas dataframe
+    :param scaler: fitted scaler, see fit_scaler and load_scaler
+    :type scaler: sklearn StandardScaler or MinMaxScaler
+    :param first_numerical_col_idx: the index of the first numerical column
+    :type first_numerical_col_idx: int
+    :param chunksize: number of rows transformed at a time
+    :type chunksize: int
+    :return: df
+    :rtype: pandas dataframe
+    """
+    # writing chunks through df.iloc touches every column block, wide tables have one block per column
+    values = df.iloc[:, first_numerical_col_idx:].to_numpy(dtype=dtypes.NORMALIZED_DTYPE, copy=True)
+    for start in range(0, len(df), chunksize):
+        values[start:start + chunksize] = scaler.transform(values[start:start + chunksize])
+    df[df.columns[first_numerical_col_idx:]] = values
+    return df
+
+
+def save_scaler(scaler, path):
+    """
+    This method saves a fitted scaler, so inference data can be normalized with the training statistics
+    :param scaler: fitted scaler
+    :type scaler: sklearn StandardScaler or MinMaxScaler
+    :param path: output path, e.g. "scaler.joblib"
+    :type path: string
+    :return: None
+    """
+    joblib.dump(scaler, path)
+
+
+def load_scaler(path):
+    """
+    This method loads a scaler saved by save_scaler
+    :param path: scaler path
+    :type path: string
+    :return: fitted scaler
+    :rtype: sklearn StandardScaler or MinMaxScaler
+    """
+    return joblib.load(path)
+
+
+def normalization(df, method, first_numerical_col_idx=2, chunksize=None, scaler=None, scaler_path=None):
+    """
+    This method normalizes the numerical columns of df, they are stored as float32
+    :param df: data, numerical columns start at first_numerical_col_idx
+    :type df: pandas dataframe
+    :param method: "standard" or "minmax", ignored if scaler is given
+    :type method: string
+    :param first_numerical_col_idx: the index of the first numerical column
+    :type first_numerical_col_idx: int
+    :param chunksize: if given, the scaler is fitted and applied chunksize rows at a time and df is normalized in
+                      place, see fit_scaler and apply_scaler
+    :type chunksize: int
+    :param scaler: fitted scaler, e.g. from load_scaler, used instead of fitting one on df
+    :type scaler: sklearn StandardScaler or MinMaxScaler
+    :param scaler_path: if given, the fitted scaler is saved there (see save_scaler)
+    :type scaler_path: string
+    :return: normalized data
+    :rtype: pandas dataframe
+    """
+    if chunksize is not None:
+        if scaler is None:
+            scaler = fit_scaler(df, method, first_numerical_col_idx, chunksize)
+        apply_scaler(df, scaler, first_numerical_col_idx, chunksize)
+        if scaler_path is not None:
+            save_scaler(scaler, scaler_path)
+        return df
     values_array = df.iloc[:, first_numerical_col_idx:].to_numpy()
-    if method == "standard":
-        scaler = preprocessing.StandardScaler().fit(values_array)
-        values_scaled = scaler.transform(values_array)
-    elif method == "minmax":
-        values_scaled = preprocessing.MinMaxScaler().fit_transform(values_array)
-    df[df.columns[first_numerical_col_idx:]] = values_scaled
+    if scaler is None:
+        if method not in SCALERS:
+            raise ValueError("method should be one of %s, got %s" % (list(SCALERS), method))
+        scaler = SCALERS[method]().fit(values_array)
+    values_scaled = scaler.transform(values_array)
+    # normalized values are kept as float32 instead of float64
+    df[df.columns[first_numerical_col_idx:]] = dtypes.normalized(values_scaled)
+    if scaler_path is not None:
+        save_scaler(scaler, scaler_path)
     return df
 
 
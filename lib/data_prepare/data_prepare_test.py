@@ -0,0 +1,146 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from . import data_prepare as dp
+
+
+def labelled_table(n_rows=200):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'id': ['SRRid%d' % i for i in range(n_rows)],
+                       'study_id': ['study%d' % (i % 3) for i in range(n_rows)],
+                       'sample_id': ['SRS%d' % i for i in range(n_rows)],
+                       'biome': rng.choice(['root:Mixed', 'root:Engineered', 'root:Host-associated'], n_rows),
+                       'exptype': rng.choice(['assembly', 'metagenomic'], n_rows)})
+    for col in ['go1', 'go2', 'taxa1']:
+        df[col] = rng.integers(0, 300, n_rows)
+    return df
+
+
+class MyTestCase(unittest.TestCase):
+    def test_split_indices(self):
+        df = labelled_table()
+        positions = dp.split_indices(df)
+        all_positions = np.concatenate([positions['train'], positions['val'], positions['test']])
+        self.assertEqual(sorted(all_positions), list(range(len(df))))
+        self.assertEqual([len(positions[split]) for split in ['train', 'val', 'test']], [140, 40, 20])
+        for split in ['train', 'val', 'test']:
+            self.assertEqual(set(df['biome'].iloc[positions[split]]), set(df['biome']))
+            self.assertTrue((positions[split] == dp.split_indices(df)[split]).all())
+
+    def test_dataset_split(self):
+        df = labelled_table()
+        with tempfile.TemporaryDirectory() as tmp:
+            df_train, df_val, df_test = dp.dataset_split(df, output_dir=tmp)
+            positions = dp.split_indices(df)
+            self.assertTrue(df_train.equals(df.iloc[positions['train']]))
+            self.assertTrue(pd.read_pickle(os.path.join(tmp, 'train_set', 'train_set.pkl')).equals(df_train))
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'train_set', 'test_set.pkl')))
+            self.assertTrue(pd.read_pickle(os.path.join(tmp, 'test_set', 'test_set.pkl')).equals(df_test))
+
+    def test_load_split(self):
+        df = labelled_table()
+        with tempfile.TemporaryDirectory() as tmp:
+            dataset_path = os.path.join(tmp, 'dataset.tsv')
+            df.to_csv(dataset_path, sep='\t', index=False)
+            manifest = dp.dataset_split(df, index_only=True, dataset_path=dataset_path, output_dir=tmp)
+            manifest_path = os.path.join(tmp, 'split_manifest.json')
+            with open(manifest_path) as f:
+                self.assertEqual(json.load(f), manifest)
+            self.assertEqual(manifest['first_numerical_col_idx'], 5)
+            self.assertEqual(manifest['seed'], 42)
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'train_set')))
+
+            df_full = dp.dataset_split(df, output_dir=tmp)
+            for split, df_expected in zip(['train', 'val', 'test'], df_full):
+                df_split = dp.load_split(manifest_path, split)
+                self.assertEqual(list(df_split['id']), list(df_expected['id']))
+                self.assertTrue((df_split.iloc[:, 5:].to_numpy() == df_expected.iloc[:, 5:].to_numpy()).all())
+                self.assertTrue((df_split.dtypes.iloc[5:] == np.uint16).all())
+                self.assertEqual(df_split['biome'].dtype, df['biome'].dtype)
+            self.assertTrue(dp.load_split(manifest_path, 'val', df).equals(df_full[1]))
+
+            with self.assertRaises(ValueError):
+                dp.load_split(manifest_path, 'train', df.iloc[::-1].reset_index(drop=True))
+            with self.assertRaises(ValueError):
+                dp.load_split(manifest_path, 'train', df.iloc[1:])
+            with self.assertRaises(ValueError):
+                dp.load_split(manifest_path, 'holdout', df)
+
+    def test_dataset_balancing(self):
+        df = labelled_table()[['biome', 'go1', 'go2', 'taxa1']]
+        df['biome'] = ['root:Mixed'] * 120 + ['root:Engineered'] * 60 + ['root:Host-associated'] * 20
+        for each_class_count in [50, 80, 500]:
+            with self.subTest(each_class_count):
+                resampled = dp.dataset_balancing(df, each_class_count, seed=0)
+                expected_sizes = resampled['biome'].value_counts().to_dict()
+                indices = dp.dataset_balancing(df, each_class_count, mode="indices", seed=0)
+                self.assertEqual(df['biome'].iloc[indices].value_counts().to_dict(), expected_sizes)
+                self.assertTrue((indices == dp.dataset_balancing(df, each_class_count, mode="indices",
+                                                                 seed=0)).all())
+                self.assertTrue(resampled.equals(dp.dataset_balancing(df, each_class_count, seed=0)))
+                weights = dp.dataset_balancing(df, each_class_count, mode="weights")
+                self.assertEqual(len(weights), len(df))
+                for label, size in expected_sizes.items():
+                    self.assertAlmostEqual(weights[(df['biome'] == label).to_numpy()].sum(), size)
+        self.assertFalse(np.array_equal(dp.dataset_balancing(df, 50, mode="indices", seed=0),
+                                        dp.dataset_balancing(df, 50, mode="indices", seed=1)))
+        with self.assertRaises(ValueError):
+            dp.dataset_balancing(df, 50, mode="smote")
+
+    def test_normalization(self):
+        for method in ['standard', 'minmax']:
+            with self.subTest(method), tempfile.TemporaryDirectory() as tmp:
+                expected = dp.normalization(labelled_table(), method, first_numerical_col_idx=5)
+                df = labelled_table()
+                scaler_path = os.path.join(tmp, 'scaler.joblib')
+                res = dp.normalization(df, method, first_numerical_col_idx=5, chunksize=30, scaler_path=scaler_path)
+                # chunked partial_fit gives the full fit, df is normalized in place
+                self.assertIs(res, df)
+                self.assertTrue((df.dtypes.iloc[5:] == np.float32).all())
+                self.assertTrue(df.iloc[:, :5].equals(labelled_table().iloc[:, :5]))
+                np.testing.assert_allclose(df.iloc[:, 5:].to_numpy(), expected.iloc[:, 5:].to_numpy(), rtol=1e-5,
+                                           atol=1e-6)
+
+                scaler = dp.load_scaler(scaler_path)
+                reloaded = dp.normalization(labelled_table(), 'unused', first_numerical_col_idx=5, chunksize=30,
+                                            scaler=scaler)
+                self.assertTrue(reloaded.equals(df))
+                reloaded = dp.normalization(labelled_table(), 'unused', first_numerical_col_idx=5, scaler=scaler)
+                np.testing.assert_allclose(reloaded.iloc[:, 5:].to_numpy(), df.iloc[:, 5:].to_numpy(), rtol=1e-5,
+                                           atol=1e-6)
+
+        with self.assertRaises(ValueError):
+            dp.normalization(labelled_table(), 'robust', first_numerical_col_idx=5)
+        with self.assertRaises(ValueError):
+            dp.normalization(labelled_table(), 'robust', first_numerical_col_idx=5, chunksize=30)
+
+    def test_normalization_wide(self):
+        n_rows, n_cols = 2000, 3000
+
+        def wide_table():
+            rng = np.random.default_rng(0)
+            df = pd.DataFrame(rng.integers(0, 300, (n_rows, n_cols)), columns=['go%d' % i for i in range(n_cols)])
+            df.insert(0, 'study_id', 'study1')
+            df.insert(0, 'id', ['SRRid%d' % i for i in range(n_rows)])
+            return df
+
+        start = time.perf_counter()
+        expected = dp.normalization(wide_table(), 'standard')
+        full_time = time.perf_counter() - start
+        df = wide_table()
+        start = time.perf_counter()
+        dp.normalization(df, 'standard', chunksize=500)
+        chunked_time = time.perf_counter() - start
+        np.testing.assert_allclose(df.iloc[:, 2:].to_numpy(), expected.iloc[:, 2:].to_numpy(), rtol=1e-4, atol=1e-5)
+        # writing chunks column block by column block took minutes here
+        self.assertLess(chunked_time, 10 * full_time + 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import gzip
 from collections import Counter
 from pathlib import Path
 
@@ -7,6 +8,7 @@ import pandas as pd
 import scipy.cluster.hierarchy as sch
 import seaborn as sns
 from matplotlib.pyplot import figure
+from scipy import sparse
 from scipy.spatial.distance import squareform
 from sklearn.metrics import classification_report
 
@@ -17,18 +19,105 @@ from ..plot import plot
 def pearson_correlation_coefficient(X):
     """
     calculate pearson correlation coefficient of matrix X
+    zero variance rows have correlation 0 with every other row
     X: numpy array (MxN)
     return pcc: numpy array (MxM)
     """
     M, N = X.shape[0], X.shape[1]  # number of features, number of data points
     X_mean = np.mean(X, axis=1).reshape(X.shape[0], 1)
     X_std = np.std(X, axis=1).reshape(X.shape[0], 1)
+    constant = np.ptp(X, axis=1) == 0
+    X_std[constant] = 1
     X_tilde = (X-X_mean)/X_std
+    X_tilde[constant] = 0
     pcc = X_tilde@X_tilde.T/N
     np.fill_diagonal(pcc, 1, wrap=False)
     return pcc
 
 
+def standardize_rows(X, dtype=np.float64, copy=True, block_size=1024):
+    """
+    standardize every row of X to zero mean and unit (population) standard deviation, block_size rows at a time
+    zero variance rows become all 0
+    X: numpy array (MxN)
+    dtype: dtype of the result, np.float32 halves the memory
+    copy: if False and X already has dtype, X is standardized in place
+    return X_tilde: numpy array (MxN)
+    """
+    X_tilde = np.array(X, dtype=dtype) if copy else np.asarray(X, dtype=dtype)
+    for start in range(0, X_tilde.shape[0], block_size):
+        rows = X_tilde[start:start + block_size]
+        constant = rows.max(axis=1, initial=-np.inf) == rows.min(axis=1, initial=np.inf)
+        rows -= rows.mean(axis=1, dtype=np.float64, keepdims=True).astype(dtype)
+        rows[constant] = 0
+        rows_std = np.sqrt(np.mean(np.square(rows, dtype=np.float64), axis=1, keepdims=True)).astype(dtype)
+        rows_std[constant] = 1
+        rows /= rows_std
+    return X_tilde
+
+
+def sparse_pearson_correlation_coefficient(X, block_size=1024):
+    """
+    calculate pearson correlation coefficient of a sparse matrix X from row sums, row sums of squares and X@X.T,
+    X is never centered so it stays sparse. zero variance rows have correlation 0 with every other row
+    X: scipy sparse matrix or numpy array (MxN)
+    block_size: number of result rows computed at a time, only the MxM result and one block_size x M block are dense
+    return pcc: numpy array (MxM)
+    """
+    X = sparse.csr_matrix(X, dtype=np.float64)
+    X.eliminate_zeros()
+    M, N = X.shape[0], X.shape[1]  # number of features, number of data points
+    X_mean = np.asarray(X.sum(axis=1)).ravel() / N
+    X_var = np.asarray(X.multiply(X).sum(axis=1)).ravel() / N - X_mean ** 2
+    nnz = X.getnnz(axis=1)
+    constant = (nnz == 0) | ((nnz == N) & (X.max(axis=1).toarray().ravel() == X.min(axis=1).toarray().ravel()))
+    inv_std = np.zeros(M)
+    inv_std[~constant] = 1 / np.sqrt(np.clip(X_var[~constant], np.finfo(np.float64).tiny, None))
+    X_T = X.T.tocsr()
+    # toarray(out=...) of a csr block accumulates into out, so the result starts zero filled
+    pcc = np.zeros((M, M))
+    for i in range(0, M, block_size):
+        rows = pcc[i:i + block_size]
+        (X[i:i + block_size] @ X_T).toarray(out=rows)
+        rows /= N
+        rows -= X_mean[i:i + block_size, None] * X_mean[None, :]
+        rows *= inv_std[i:i + block_size, None]
+        rows *= inv_std[None, :]
+    np.clip(pcc, -1, 1, out=pcc)
+    np.fill_diagonal(pcc, 1, wrap=False)
+    return pcc
+
+
+def pearson_correlation_coefficient_blocked(X, block_size=1024, dtype=np.float64, out_path=None, copy=True):
+    """
+    calculate pearson correlation coefficient of matrix X tile by tile, same result as
+    pearson_correlation_coefficient without holding a second MxM temporary
+    X: numpy array (MxN)
+    block_size: number of features in a tile
+    dtype: dtype of the computation and of the result, np.float32 halves the memory
+    out_path: if given, the result is a memory-mapped .npy file at this path instead of an in-memory array
+    copy: if False and X already has dtype, X is standardized in place instead of copied
+    return pcc: numpy array or numpy memmap (MxM)
+    """
+    M, N = X.shape[0], X.shape[1]  # number of features, number of data points
+    X_tilde = standardize_rows(X, dtype, copy, block_size)
+    if out_path is not None:
+        pcc = np.lib.format.open_memmap(out_path, mode='w+', dtype=dtype, shape=(M, M))
+    else:
+        pcc = np.empty((M, M), dtype=dtype)
+    for i in range(0, M, block_size):
+        for j in range(i, M, block_size):
+            tile = X_tilde[i:i + block_size] @ X_tilde[j:j + block_size].T
+            tile /= N
+            pcc[i:i + block_size, j:j + block_size] = tile
+            if j != i:
+                pcc[j:j + block_size, i:i + block_size] = tile.T
+    np.fill_diagonal(pcc, 1, wrap=False)
+    if out_path is not None:
+        pcc.flush()
+    return pcc
+
+
 def cluster_corr(corr_array, distance_method=None, absolute_value=True, threshold=None, inplace=False):
     """
     Rearranges the correlation matrix, corr_array, so that groups of highly
@@ -82,15 +171,59 @@ def feature_extraction(pcc_mat, cutoff):
     return: a list of feature mask, True means selected, False means not selected
     """
     M = pcc_mat.shape[0]  # number of features
-    feature_mask = [True] * M
-    pcc_mat_abs = np.abs(pcc_mat)
-    for i in range(M):
-        for j in range(i):
-            if pcc_mat_abs[i][j] >= cutoff:
-                pcc_mat_abs[i, :] = 0
-                pcc_mat_abs[:, i] = 0
-                feature_mask[i] = False
-    return feature_mask
+    # feature i is removed if it's correlated with any earlier feature that is kept
+    feature_mask = np.ones(M, dtype=bool)
+    for i in range(1, M):
+        feature_mask[i] = not np.any((np.abs(pcc_mat[i, :i]) >= cutoff) & feature_mask[:i])
+    return feature_mask.tolist()
+
+
+def correlated_pairs(X, cutoff, block_size=1024, dtype=np.float64):
+    """
+    find all feature pairs whose absolute pearson correlation coefficient is at least cutoff, without the full
+    MxM matrix. Memory is the standardized X, one block_size x block_size tile and the pairs found
+    X: numpy array (MxN)
+    cutoff: pcc value threshold
+    block_size: number of features in a tile
+    dtype: dtype of the computation, np.float32 halves the memory
+    return rows, cols, values: numpy arrays of the pairs, rows[k] > cols[k]
+    """
+    M, N = X.shape[0], X.shape[1]  # number of features, number of data points
+    X_tilde = standardize_rows(X, dtype, True, block_size)
+    rows, cols, values = [], [], []
+    for i in range(0, M, block_size):
+        for j in range(0, i + 1, block_size):
+            tile = X_tilde[i:i + block_size] @ X_tilde[j:j + block_size].T
+            tile /= N
+            r, c = np.nonzero(np.abs(tile) >= cutoff)
+            lower = r + i > c + j
+            rows.append(r[lower] + i)
+            cols.append(c[lower] + j)
+            values.append(tile[r[lower], c[lower]])
+    if not rows:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=dtype)
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+
+
+def feature_extraction_from_pairs(rows, cols, M):
+    """
+    same feature mask as feature_extraction, from the list of correlated pairs instead of the full PCC matrix
+    rows, cols: numpy arrays of correlated feature pairs, see correlated_pairs
+    M: number of features
+    return: a list of feature mask, True means selected, False means not selected
+    """
+    feature_mask = np.ones(M, dtype=bool)
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    lower = rows > cols
+    rows, cols = rows[lower], cols[lower]
+    order = np.argsort(rows, kind='stable')
+    rows, cols = rows[order], cols[order]
+    features, starts = np.unique(rows, return_index=True)
+    ends = np.append(starts[1:], len(rows))
+    for i, start, end in zip(features, starts, ends):
+        # features before i are already final
+        feature_mask[i] = not feature_mask[cols[start:end]].any()
+    return feature_mask.tolist()
 
 
 def generate_symmetric_matrix(low_bound, high_bound, shape):
@@ -170,6 +303,83 @@ def pairwise_correlation(names_list, pcc_mat):
     return res
 
 
+def iter_pairwise_correlation(names_list, pcc_mat, threshold=None, block_size=1024, max_pairs=500000):
+    """
+    This method generates the pair wise correlation table of pairwise_correlation chunk by chunk, in the same order.
+    A chunk covers at most max_pairs pairs, i.e. at most 2 * max_pairs rows, whether or not threshold is given.
+    Only the pcc_mat rows of one chunk are read at a time, so pcc_mat can be a memory-mapped matrix
+    :param names_list: the name list of the objects
+    :type names_list:  list
+    :param pcc_mat:  pearson correlation coefficient matrix
+    :type pcc_mat: numpy array or numpy memmap
+    :param threshold: if given, only pairs with absolute correlation at least threshold are generated
+    :type threshold: float
+    :param block_size: maximum number of pcc_mat rows in a chunk
+    :type block_size: int
+    :param max_pairs: maximum number of pairs in a chunk
+    :type max_pairs: int
+    :return: chunks with columns ['object_1','object_2', 'pearson correlation']
+    :rtype: generator of pandas dataframe
+    """
+    names = np.asarray(names_list, dtype=object)
+    M = len(names)
+    # a pcc_mat row has at most M - 1 pairs, rows longer than max_pairs are split into column segments
+    rows_per_chunk = max(1, min(block_size, max_pairs // max(M - 1, 1)))
+    for start in range(0, M - 1, rows_per_chunk):
+        block = np.asarray(pcc_mat[start:start + rows_per_chunk])
+        for col_start in range(start + 1, M, max_pairs):
+            segment = block[:, col_start:col_start + max_pairs]
+            mask = np.triu(np.ones(segment.shape, dtype=bool), k=start + 1 - col_start)
+            if threshold is not None:
+                mask &= np.abs(segment) >= threshold
+            rows, cols = np.nonzero(mask)
+            values = segment[rows, cols]
+            rows += start
+            cols += col_start
+            yield pd.DataFrame({'object_1': np.column_stack([names[rows], names[cols]]).ravel(),
+                                'object_2': np.column_stack([names[cols], names[rows]]).ravel(),
+                                'pearson correlation': np.repeat(values, 2)})
+
+
+def write_pairwise_correlation(names_list, pcc_mat, output_file, threshold=None, block_size=1024, max_pairs=500000):
+    """
+    This method writes the pair wise correlation table chunk by chunk instead of building it in memory
+    :param names_list: the name list of the objects
+    :type names_list:  list
+    :param pcc_mat:  pearson correlation coefficient matrix
+    :type pcc_mat: numpy array or numpy memmap
+    :param output_file: output path, ".parquet" writes parquet, ".gz" writes gzip compressed tsv, otherwise tsv
+    :type output_file: string
+    :param threshold: if given, only pairs with absolute correlation at least threshold are written
+    :type threshold: float
+    :param block_size: maximum number of pcc_mat rows in a chunk
+    :type block_size: int
+    :param max_pairs: maximum number of pairs in a chunk, see iter_pairwise_correlation
+    :type max_pairs: int
+    :return: number of rows written
+    :rtype: int
+    """
+    chunks = iter_pairwise_correlation(names_list, pcc_mat, threshold, block_size, max_pairs)
+    n_rows = 0
+    if output_file.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([('object_1', pa.string()), ('object_2', pa.string()),
+                            ('pearson correlation', pa.from_numpy_dtype(np.asarray(pcc_mat[:0]).dtype))])
+        with pq.ParquetWriter(output_file, schema) as writer:
+            for chunk in chunks:
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                n_rows += len(chunk)
+        return n_rows
+    opener = gzip.open if output_file.endswith('.gz') else open
+    with opener(output_file, 'wt') as f:
+        f.write('object_1\tobject_2\tpearson correlation\n')
+        for chunk in chunks:
+            chunk.to_csv(f, sep='\t', header=False, index=False)
+            n_rows += len(chunk)
+    return n_rows
+
+
 def top_prob_labels(class_list, sample, prob_array, num_prob=None, plot=False, num_bar=10):
     """
     This method gives num most likely labels based on probability and plot the bar char
@@ -294,7 +504,31 @@ def model_analysis(model, X_test, y_test):
     return report
 
 
-def feature_selection(df, cutoff=0.9):
+def _correlation_mask(X, cutoff, method, block_size):
+    """
+    feature mask of feature_extraction for the rows of X, computed with the full PCC matrix, correlated pairs or
+    the PCC matrix of a CSR matrix X (see sparse_pearson_correlation_coefficient)
+    """
+    if method == "full":
+        return feature_extraction(pearson_correlation_coefficient(X), cutoff)
+    elif method == "pairs":
+        rows, cols, _ = correlated_pairs(X, cutoff, block_size)
+        return feature_extraction_from_pairs(rows, cols, X.shape[0])
+    elif method == "sparse":
+        return feature_extraction(sparse_pearson_correlation_coefficient(X), cutoff)
+    raise ValueError("method should be 'full', 'pairs' or 'sparse', got %s" % method)
+
+
+def _csr_values(df):
+    """
+    values of df as a CSR matrix, pandas sparse columns are converted without densifying them
+    """
+    if len(df.columns) and all(isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes):
+        return df.sparse.to_coo().tocsr()
+    return sparse.csr_matrix(df.to_numpy())
+
+
+def feature_selection(df, cutoff=0.9, method="full", block_size=1024):
     """
     This method takes features table and filters out features util correlation of any pair is below the cutoff
     :param df: feature table, N x (M + 1) M: number of features plus one label column ('biome')
@@ -302,14 +536,27 @@ def feature_selection(df, cutoff=0.9):
     :param cutoff:  when a pair of features correlation coefficient number is above this threshold, the feature
                     with smaller index will be removed
     :type cutoff: float
+    :param method: "full" computes the whole PCC matrix, "pairs" only keeps feature pairs above cutoff
+                   (see correlated_pairs), memory grows with the number of correlated pairs instead of M x M.
+                   "sparse" keeps the features as a CSR matrix and never centers them
+                   (see sparse_pearson_correlation_coefficient), for tables with pandas sparse columns
+    :type method: string
+    :param block_size: number of features in a tile for method "pairs"
+    :type block_size: int
     :return: feature table after removing highly correlated features
     :rtype: pandas dataframe work
     """
     df = df.set_index('biome')
-    df = clean.rows_and_cols_quant_filter(df, start_col_index=1)
-    feature_mat = df.to_numpy().transpose()
-    pcc_mat = pearson_correlation_coefficient(feature_mat)
-    feature_mask = feature_extraction(pcc_mat, cutoff)
+    if method == "sparse":
+        values = _csr_values(df)
+        row_mask, col_mask = clean.rows_and_cols_quant_filter(values, start_col_index=1, pandas=False,
+                                                              return_masks=True)
+        df = df.loc[row_mask, col_mask]
+        feature_mat = values[row_mask][:, col_mask].T.tocsr()
+    else:
+        df = clean.rows_and_cols_quant_filter(df, start_col_index=1)
+        feature_mat = df.to_numpy().transpose()
+    feature_mask = _correlation_mask(feature_mat, cutoff, method, block_size)
     selected_features = df.columns[feature_mask]
     df = df[selected_features]
     df.insert(0, 'biome', df.index, True)
@@ -317,35 +564,103 @@ def feature_selection(df, cutoff=0.9):
     return df
 
 
-def get_high_present_samples(df, first_numerical_col_idx, threshold):
-    df.reset_index(drop=True, inplace=True)
-    bin_df = df.iloc[:, first_numerical_col_idx:]
-    bin_feature = np.where(bin_df.to_numpy()>0, 1, 0)
-    bin_df[:] = bin_feature
-    present_sum = bin_df.sum(axis=1)
-    great = []
-    for i, n in enumerate(present_sum):
-        if n >= threshold:
-            great.append(i)
-    df = df.filter(items=great, axis=0)
+def presence_counts(data, first_numerical_col_idx=0, block_size=1024):
+    """
+    This method counts present (> 0) features of every row without a binary copy of the data
+    :param data: data table, or feature matrix if first_numerical_col_idx is 0
+    :type data: pandas dataframe, numpy array or scipy sparse matrix
+    :param first_numerical_col_idx: the index of the first feature column
+    :type first_numerical_col_idx: int
+    :param block_size: number of rows compared at a time for numpy arrays
+    :type block_size: int
+    :return: number of present features of each row
+    :rtype: numpy array
+    """
+    if isinstance(data, pd.DataFrame):
+        # one column at a time, so at most one extra column is allocated
+        counts = np.zeros(len(data), dtype=np.int64)
+        for i in range(first_numerical_col_idx, data.shape[1]):
+            counts += data.iloc[:, i].to_numpy() > 0
+        return counts
+    if sparse.issparse(data):
+        data = sparse.csr_matrix(data[:, first_numerical_col_idx:])
+        return np.diff((data > 0).indptr)
+    values = np.asarray(data)[:, first_numerical_col_idx:]
+    return np.concatenate([np.count_nonzero(values[start:start + block_size] > 0, axis=1)
+                           for start in range(0, values.shape[0], block_size)] or [np.zeros(0, dtype=np.int64)])
+
+
+def get_high_present_samples(df, first_numerical_col_idx, threshold, return_mask=False):
+    """
+    This method keeps rows with at least threshold present (> 0) features. df is not modified
+    :param df: data table
+    :type df: pandas dataframe
+    :param first_numerical_col_idx: the index of the first feature column
+    :type first_numerical_col_idx: int
+    :param threshold: minimum number of present features
+    :type threshold: int
+    :param return_mask: if True, return the row mask instead of the filtered table
+    :type return_mask: boolean
+    :return: kept rows, indexed by their position in df
+    :rtype: pandas dataframe
+    """
+    mask = presence_counts(df, first_numerical_col_idx) >= threshold
+    if return_mask:
+        return mask
+    df = df[mask]
+    df.index = np.flatnonzero(mask)
     return df
 
 
-def row_corr_filter(df, cutoff=0.9):
+def get_high_present_samples_chunked(input_file, output_file, first_numerical_col_idx, threshold, chunksize=10000):
+    """
+    This method writes the rows of a tsv table with at least threshold present (> 0) features, streaming the file
+    twice instead of loading it. Same rows as get_high_present_samples
+    :param input_file: tsv table
+    :type input_file: string
+    :param output_file: output tsv path
+    :type output_file: string
+    :param first_numerical_col_idx: the index of the first feature column
+    :type first_numerical_col_idx: int
+    :param threshold: minimum number of present features
+    :type threshold: int
+    :param chunksize: number of rows parsed at a time
+    :type chunksize: int
+    :return: row mask of the input table
+    :rtype: numpy array
+    """
+    file_stats = clean.scan_file(input_file, first_numerical_col_idx, chunksize=chunksize)
+    row_mask = file_stats['presence'] >= threshold
+    col_mask = np.ones(len(file_stats['columns']), dtype=bool)
+    clean.write_filtered_file(input_file, output_file, row_mask, col_mask, chunksize)
+    return row_mask
+
+
+def row_corr_filter(df, cutoff=0.9, method="full", block_size=1024):
     """
     filter out rows that are highly correlated
     :param cutoff: correlation filter threshold
     :type cutoff: float
     :param df: data table
     :type df: pandas df
+    :param method: "full", "pairs" or "sparse", see feature_selection
+    :type method: string
+    :param block_size: number of rows in a tile for method "pairs"
+    :type block_size: int
     :return: data table
     :rtype: pandas df
     """
-    df = clean.rows_and_cols_quant_filter(df, start_col_index=1)
-    df = df.set_index('biome')
-    row_mat = df.to_numpy()
-    pcc_mat = pearson_correlation_coefficient(row_mat)
-    mask = feature_extraction(pcc_mat, cutoff)
+    if method == "sparse":
+        values = _csr_values(df.iloc[:, 1:])
+        row_mask, col_mask = clean.rows_and_cols_quant_filter(values, start_col_index=0, pandas=False,
+                                                              return_masks=True)
+        df = df.loc[row_mask, np.concatenate([[True], col_mask])].set_index('biome')
+        row_mat = values[row_mask][:, col_mask]
+    else:
+        df = clean.rows_and_cols_quant_filter(df, start_col_index=1)
+        df = df.set_index('biome')
+        row_mat = df.to_numpy()
+    mask = _correlation_mask(row_mat, cutoff, method, block_size)
     df = df[mask]
     return df
 
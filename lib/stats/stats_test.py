@@ -1,7 +1,11 @@
+import os
+import tempfile
 import unittest
+from scipy import sparse
 from scipy.stats import pearsonr
 from stats import *
 import numpy as np
+import pandas as pd
 
 
 class TestStats(unittest.TestCase):
@@ -24,6 +28,61 @@ class TestStats(unittest.TestCase):
                     true_pcc[j][i] = p
         self.assertEqual(np.round(my_pcc, 5).all(), np.round(true_pcc, 5).all())
 
+    def test_pearson_correlation_coefficient_blocked(self):
+        """
+        test tiled pearson_correlation_coefficient against the full matrix version
+        """
+        test_array = np.random.rand(10, 6)
+        true_pcc = pearson_correlation_coefficient(test_array)
+        self.assertTrue(np.allclose(pearson_correlation_coefficient_blocked(test_array, block_size=3), true_pcc))
+        pcc_32 = pearson_correlation_coefficient_blocked(test_array, block_size=4, dtype=np.float32)
+        self.assertEqual(pcc_32.dtype, np.float32)
+        self.assertTrue(np.allclose(pcc_32, true_pcc, atol=1e-5))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_path = os.path.join(tmp_dir, 'pcc.npy')
+            pearson_correlation_coefficient_blocked(test_array, block_size=3, out_path=out_path)
+            self.assertTrue(np.allclose(np.load(out_path, mmap_mode='r'), true_pcc))
+
+    def test_sparse_pearson_correlation_coefficient(self):
+        """
+        test sparse pearson_correlation_coefficient against the dense version, zero variance rows correlate with nothing
+        """
+        test_array = np.random.rand(8, 20)
+        test_array[test_array < 0.7] = 0
+        test_array[2] = 0
+        test_array[5] = 3
+        true_pcc = pearson_correlation_coefficient(test_array)
+        self.assertFalse(np.isnan(true_pcc).any())
+        self.assertTrue(np.all(true_pcc[2, [0, 1, 3, 4, 5, 6, 7]] == 0))
+        self.assertEqual(true_pcc[5, 5], 1)
+        my_pcc = sparse_pearson_correlation_coefficient(sparse.csr_matrix(test_array))
+        self.assertTrue(np.allclose(my_pcc, true_pcc))
+        my_pcc = sparse_pearson_correlation_coefficient(sparse.csr_matrix(test_array), block_size=3)
+        self.assertTrue(np.allclose(my_pcc, true_pcc))
+
+    def test_feature_selection_sparse(self):
+        """
+        test method "sparse" of feature_selection and row_corr_filter against method "full", also for pandas sparse
+        columns
+        """
+        rng = np.random.default_rng(0)
+        values = rng.integers(0, 4, (30, 12)) * (rng.random((30, 12)) < 0.4)
+        values[:, 3] = values[:, 1] * 2
+        values[7] = values[2]
+        df = pd.DataFrame(values, columns=['f%d' % i for i in range(12)])
+        df.insert(0, 'biome', rng.choice(['a', 'b'], 30))
+        sparse_df = df.astype({col: pd.SparseDtype(int, 0) for col in df.columns[1:]})
+        true_features = feature_selection(df, 0.9)
+        true_rows = row_corr_filter(df, 0.9)
+        self.assertTrue(len(true_features.columns) < 13 and len(true_rows) < 30)
+        for data in [df, sparse_df]:
+            features = feature_selection(data, 0.9, method="sparse")
+            self.assertEqual(list(features.columns), list(true_features.columns))
+            self.assertTrue((features.iloc[:, 1:].to_numpy() == true_features.iloc[:, 1:].to_numpy()).all())
+            rows = row_corr_filter(data, 0.9, method="sparse")
+            self.assertEqual(list(rows.index), list(true_rows.index))
+            self.assertEqual(list(rows.columns), list(true_rows.columns))
+
     def test_feature_selection_method(self):
         """
         This test checks if each pair features' pearson correlation is below the threshold
@@ -36,6 +95,39 @@ class TestStats(unittest.TestCase):
                 r, c = true_idx[i], true_idx[j]
                 self.assertTrue(pcc[r, c] < 0.9)
 
+    def test_feature_extraction_same_as_loop(self):
+        """
+        feature_extraction keeps the earliest feature and removes later correlated ones, like the original double loop
+        """
+        def feature_extraction_loop(pcc_mat, cutoff):
+            M = pcc_mat.shape[0]
+            feature_mask = [True] * M
+            pcc_mat_abs = np.abs(pcc_mat)
+            for i in range(M):
+                for j in range(i):
+                    if pcc_mat_abs[i][j] >= cutoff:
+                        pcc_mat_abs[i, :] = 0
+                        pcc_mat_abs[:, i] = 0
+                        feature_mask[i] = False
+            return feature_mask
+
+        for cutoff in [0.5, 0.8, 0.9]:
+            pcc = generate_symmetric_matrix(-1, 1, (30, 30))
+            self.assertEqual(feature_extraction(pcc, cutoff), feature_extraction_loop(pcc, cutoff))
+
+    def test_correlated_pairs(self):
+        """
+        feature mask from pairs above cutoff is the same as from the full PCC matrix
+        """
+        test_array = np.random.rand(12, 5)
+        pcc = pearson_correlation_coefficient(test_array)
+        for cutoff in [0.5, 0.8, 0.9]:
+            rows, cols, values = correlated_pairs(test_array, cutoff, block_size=5)
+            self.assertTrue(np.all(rows > cols))
+            self.assertTrue(np.allclose(values, pcc[rows, cols]))
+            self.assertEqual(len(rows), np.sum(np.tril(np.abs(pcc) >= cutoff, k=-1)))
+            self.assertEqual(feature_extraction_from_pairs(rows, cols, 12), feature_extraction(pcc, cutoff))
+
     def test_pairwise_correlation(self):
         test_pcc = np.array([[0., 0.84, 0.9],
                             [0.84, 0., 0.87],
@@ -53,5 +145,47 @@ class TestStats(unittest.TestCase):
         self.assertEqual(res, target)
 
 
+    def test_write_pairwise_correlation(self):
+        test_pcc = np.array([[0., 0.84, 0.9],
+                            [0.84, 0., 0.87],
+                            [0.9, 0.87, 0.]])
+        names = ['A', 'B', 'C']
+        res = pd.concat(iter_pairwise_correlation(names, test_pcc, block_size=2))
+        self.assertEqual([list(row) for row in res.itertuples(index=False)], pairwise_correlation(names, test_pcc)[1:])
+        chunks = list(iter_pairwise_correlation(names, test_pcc, max_pairs=1))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 2])
+        res = pd.concat(chunks)
+        self.assertEqual([list(row) for row in res.itertuples(index=False)], pairwise_correlation(names, test_pcc)[1:])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file = os.path.join(tmp_dir, 'pairs.tsv.gz')
+            self.assertEqual(write_pairwise_correlation(names, test_pcc, output_file, threshold=0.85), 4)
+            res = pd.read_csv(output_file, sep='\t')
+            self.assertEqual(list(res['object_1']), ['A', 'C', 'B', 'C'])
+            self.assertEqual(list(res['pearson correlation']), [0.9, 0.9, 0.87, 0.87])
+
+
+    def test_get_high_present_samples(self):
+        df = pd.DataFrame({'biome': ['a', 'b', 'c', 'd'], 'f1': [0, 1, 2, 0], 'f2': [0, 0, 3, 1], 'f3': [1, 0, 4, 2]},
+                          index=[5, 6, 7, 8])
+        res = get_high_present_samples(df, 1, 2)
+        self.assertEqual(list(res.index), [2, 3])
+        self.assertEqual(list(res['biome']), ['c', 'd'])
+        self.assertEqual(list(df.index), [5, 6, 7, 8])
+        values = df.iloc[:, 1:].to_numpy()
+        self.assertEqual(list(presence_counts(values, block_size=3)), [1, 1, 3, 2])
+        self.assertEqual(list(presence_counts(sparse.csr_matrix(values))), [1, 1, 3, 2])
+
+    def test_get_high_present_samples_chunked(self):
+        df = pd.DataFrame({'biome': ['a', 'b', 'c', 'd'], 'f1': [0, 1, 2, 0], 'f2': [0, 0, 3, 1], 'f3': [1, 0, 4, 2]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = os.path.join(tmp_dir, 'input.tsv')
+            output_file = os.path.join(tmp_dir, 'output.tsv')
+            df.to_csv(input_file, sep='\t', index=False)
+            get_high_present_samples_chunked(input_file, output_file, 1, 2, chunksize=3)
+            res = get_high_present_samples(df.copy(), 1, 2)
+            self.assertTrue(pd.read_csv(output_file, sep='\t').equals(res.reset_index(drop=True)))
+
+
 if __name__ == '__main__':
     unittest.main()
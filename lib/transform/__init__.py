@@ -4,6 +4,8 @@ import pandas as pd
 import numpy as np
 import csv
 
+from .aggregate import ordered_map
+
 
 def regex_filtered(a_list):
     """
@@ -18,31 +20,45 @@ def regex_filtered(a_list):
     return new_list
 
 
-def collect_all_unique_terms(study_dict, studies):
+def _study_terms(studies, study_name, files_list):
+    """
+    This method collects the GO and taxonomy terms of one study
+    :return: two sets of GO and taxonomy terms
+    :rtype: set, set
+    """
+    go_terms = set()
+    taxa_terms = set()
+    for file in files_list:
+        tsv_path = os.path.join(studies, study_name, file)
+        if re.match(r'.*GO.*', file):
+            with open(tsv_path) as fd:
+                tsv_df = pd.read_csv(fd, sep='\t')
+                go_terms.update(tsv_df['GO'])
+        elif re.match(r'.*taxonomy.*', file):
+            with open(tsv_path) as fd:
+                tsv_df = pd.read_csv(fd, sep='\t')
+                taxa_terms.update(tsv_df['#SampleID'])
+    return go_terms, taxa_terms
+
+
+def collect_all_unique_terms(study_dict, studies, n_jobs=1):
     """
     This methods loops through the studies folder to collect all unique GO and taxonomy terms
     :param study_dict:
     :type study_dict: dictionary
     :param studies: path to studies folder
     :type studies: string
+    :param n_jobs: number of worker processes reading studies, -1 uses all cores
+    :type n_jobs: int
     :return: two lists of all unique GO and taxonomy terms
     :rtype: list, list
     """
     all_go_terms = set()
     all_taxa_terms = set()
-    for study_name, files_list in study_dict.items():
-        for file in files_list:
-            tsv_path = os.path.join(studies, study_name, file)
-            if re.match(r'.*GO.*', file):
-                with open(tsv_path) as fd:
-                    tsv_df = pd.read_csv(fd, sep='\t')
-                    go_terms = set(tsv_df['GO'])
-                    all_go_terms.update(go_terms)
-            elif re.match(r'.*taxonomy.*', file):
-                with open(tsv_path) as fd:
-                    tsv_df = pd.read_csv(fd, sep='\t')
-                    taxa_terms = set(tsv_df['#SampleID'])
-                    all_taxa_terms.update(taxa_terms)
+    tasks = ((studies, study_name, files_list) for study_name, files_list in study_dict.items())
+    for go_terms, taxa_terms in ordered_map(_study_terms, tasks, n_jobs):
+        all_go_terms.update(go_terms)
+        all_taxa_terms.update(taxa_terms)
     return all_go_terms, all_taxa_terms
 
 
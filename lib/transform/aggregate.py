@@ -1,8 +1,25 @@
+import collections
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 import csv
+from scipy import sparse
+
+if __package__:
+    from . import dtypes
+    from . import parquet_dataset
+    from . import sparse_matrix
+else:
+    # run from the transform folder, e.g. by transform_test
+    import dtypes
+    import parquet_dataset
+    import sparse_matrix
+
+# same format as csv.writer(f, delimiter='\t')
+_BLOCK_CSV_KWARGS = dict(sep='\t', header=False, index=False, na_rep='nan', lineterminator='\r\n')
 
 
 def regex_filtered(a_list):
@@ -18,7 +35,102 @@ def regex_filtered(a_list):
     return new_list
 
 
-def generate_all_aggregated(study_dict, output_file_path, studies, all_go_terms, all_taxa_terms):
+def read_study(studies, study_name, files_list, compact=False):
+    """
+    This method reads the GO and taxonomy abundance tables of one study
+    :param studies: path to Mgnify studies
+    :type studies: string
+    :param study_name: study directory name
+    :type study_name: string
+    :param files_list: files of interest in the study directory
+    :type files_list: list
+    :param compact: if true, abundance columns get one compact dtype, see dtypes.compact_columns. Only for numeric
+                    outputs, tsv writers need the values as read so their text doesn't change
+    :type compact: boolean
+    :return: GO abundance table and taxonomy abundance table
+    :rtype: pandas dataframe, pandas dataframe
+    """
+    go_df, taxa_df = None, None
+    for file in files_list:
+        tsv_path = os.path.join(studies, study_name, file)
+        if re.match(r'.*GO.*', file):
+            with open(tsv_path) as fd:
+                go_df = pd.read_csv(fd, sep='\t')
+        elif re.match(r'.*taxonomy.*', file):
+            with open(tsv_path) as fd:
+                taxa_df = pd.read_csv(fd, sep='\t')
+    if go_df is None or taxa_df is None:
+        raise ValueError("study %s doesn't have both GO and taxonomy abundance files" % study_name)
+    if compact:
+        go_df = dtypes.compact_columns(go_df, 3)
+        taxa_df = dtypes.compact_columns(taxa_df, 1)
+    return go_df, taxa_df
+
+
+def _align_terms(df, term_col, common_ids, all_terms):
+    """
+    This method aligns one abundance table to the global term index, one row per id
+    :param df: abundance table, terms in rows and ids in columns
+    :type df: pandas dataframe
+    :param term_col: name of the term column, 'GO' or '#SampleID'
+    :type term_col: string
+    :param common_ids: ids shared by GO and taxonomy tables
+    :type common_ids: list
+    :param all_terms: global term index
+    :type all_terms: list
+    :return: ids x terms table, missing terms are 0
+    :rtype: pandas dataframe
+    """
+    values = df.drop_duplicates(term_col, keep='last').set_index(term_col)[common_ids]
+    if not all(dtype.kind in 'iu' for dtype in values.dtypes):
+        # keep every value's own type and write missing terms as an integer 0, as the row by row writer does
+        values = values.astype(object)
+    return values.reindex(list(all_terms), fill_value=0).T
+
+
+def _common_ids(study_name, go_df, taxa_df):
+    """
+    This method finds the run/assembly ids present in both GO and taxonomy tables of a study
+    :return: sorted common ids, empty if the GO table has no rows
+    :rtype: list
+    """
+    common_ids = list(np.intersect1d(go_df.columns[3:], taxa_df.columns[1:]))
+    if len(common_ids) == 0:
+        print("\nstudy_name:", study_name)
+        print("\n\tgo_ids:", go_df.columns[3:])
+        print("\n\ttaxa_ids:", taxa_df.columns[1:])
+    if go_df.empty:
+        common_ids = []
+    return common_ids
+
+
+def study_block(study_name, go_df, taxa_df, all_go_terms, all_taxa_terms):
+    """
+    This method builds the aggregated rows of one study
+    :param study_name: study directory name
+    :type study_name: string
+    :param go_df: GO abundance table
+    :type go_df: pandas dataframe
+    :param taxa_df: taxonomy abundance table
+    :type taxa_df: pandas dataframe
+    :param all_go_terms: all unique GO terms
+    :type all_go_terms: list
+    :param all_taxa_terms: all unique taxon terms
+    :type all_taxa_terms: list
+    :return: table with columns ['id', 'study_id'] + all_go_terms + all_taxa_terms
+    :rtype: pandas dataframe
+    """
+    common_ids = _common_ids(study_name, go_df, taxa_df)
+    go_block = _align_terms(go_df, 'GO', common_ids, all_go_terms)
+    taxa_block = _align_terms(taxa_df, '#SampleID', common_ids, all_taxa_terms)
+    block = pd.concat([go_block, taxa_block], axis=1)
+    block.insert(0, 'id', common_ids)
+    block.insert(1, 'study_id', study_name)
+    return block
+
+
+def generate_all_aggregated(study_dict, output_file_path, studies, all_go_terms, all_taxa_terms, engine="loop",
+                            n_jobs=1):
     """
     This method generates aggregated
     :param study_dict: a dict contains all files of interest in each Mgnify study directory : {study: [file1, file2]}
@@ -31,8 +143,20 @@ def generate_all_aggregated(study_dict, output_file_path, studies, all_go_terms,
     :type all_go_terms: list
     :param all_taxa_terms: all unique taxon terms
     :type all_taxa_terms: list
+    :param engine: "loop" fills rows term by term, "pivot" reindexes each study to the global term index
+                   and writes the whole study block at once. Both give the same output file
+    :type engine: string
+    :param n_jobs: number of worker processes parsing and pivoting studies, -1 uses all cores. Pivot engine only
+    :type n_jobs: int
     :return: None
     """
+    if engine == "pivot":
+        _generate_all_aggregated_pivot(study_dict, output_file_path, studies, all_go_terms, all_taxa_terms, n_jobs)
+        return
+    elif engine != "loop":
+        raise ValueError("engine should be 'loop' or 'pivot', got %s" % engine)
+    elif n_jobs != 1:
+        raise ValueError("n_jobs is only supported by the pivot engine")
     with open(output_file_path, 'w') as f:
         writer = csv.writer(f, delimiter='\t')
         # Write headers
@@ -81,4 +205,241 @@ def generate_all_aggregated(study_dict, output_file_path, studies, all_go_terms,
                     row_flat.append(rows_dict[item['id']].get(go_term, 0))
                 for taxa_term in all_taxa_terms:
                     row_flat.append(rows_dict[item['id']].get(taxa_term, 0))
-                writer.writerow(row_flat)
\ No newline at end of file
+                writer.writerow(row_flat)
+
+
+def ordered_map(func, tasks, n_jobs=1):
+    """
+    This method runs func(*task) for every task in a process pool and yields the results in task order,
+    so a single consumer can merge them deterministically. At most 2 * n_jobs tasks are in flight.
+    :param func: a picklable module level function
+    :type func: function
+    :param tasks: argument tuples
+    :type tasks: iterable
+    :param n_jobs: number of worker processes, 1 runs in the current process, -1 uses all cores
+    :type n_jobs: int
+    :return: results of func in task order
+    :rtype: generator
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs < 1:
+        raise ValueError("n_jobs should be -1 or a positive integer, got %s" % n_jobs)
+    if n_jobs == 1:
+        for task in tasks:
+            yield func(*task)
+        return
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(executor.submit(func, *task))
+            if len(pending) >= 2 * n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _pivot_study_text(studies, study_name, files_list, all_go_terms, all_taxa_terms):
+    """
+    This method reads and pivots one study and returns its rows as tsv text, used by pool workers
+    """
+    go_df, taxa_df = read_study(studies, study_name, files_list)
+    block = study_block(study_name, go_df, taxa_df, all_go_terms, all_taxa_terms)
+    return block.to_csv(**_BLOCK_CSV_KWARGS)
+
+
+def _generate_all_aggregated_pivot(study_dict, output_file_path, studies, all_go_terms, all_taxa_terms, n_jobs=1):
+    """
+    Pivot engine of generate_all_aggregated, see generate_all_aggregated for params
+    """
+    all_go_terms, all_taxa_terms = list(all_go_terms), list(all_taxa_terms)
+    tasks = ((studies, study_name, files_list, all_go_terms, all_taxa_terms)
+             for study_name, files_list in study_dict.items())
+    with open(output_file_path, 'w') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(['id', 'study_id'] + all_go_terms + all_taxa_terms)
+        for text in ordered_map(_pivot_study_text, tasks, n_jobs):
+            f.write(text)
+
+
+def write_block(f, block):
+    """
+    This method appends an aggregated block to an open tsv file, same format as csv.writer
+    :param f: output file handle
+    :type f: file object
+    :param block: aggregated rows
+    :type block: pandas dataframe
+    :return: None
+    """
+    block.to_csv(f, **_BLOCK_CSV_KWARGS)
+
+
+def _sparse_terms(df, term_col, common_ids):
+    """
+    This method converts one abundance table to a sparse ids x terms matrix
+    :param df: abundance table, terms in rows and ids in columns
+    :type df: pandas dataframe
+    :param term_col: name of the term column, 'GO' or '#SampleID'
+    :type term_col: string
+    :param common_ids: ids shared by GO and taxonomy tables
+    :type common_ids: list
+    :return: terms of the table, matrix of shape (len(common_ids), len(terms))
+    :rtype: list, scipy.sparse.csr_matrix
+    """
+    df = df.drop_duplicates(term_col, keep='last')
+    return list(df[term_col]), sparse.csr_matrix(df[common_ids].to_numpy().T)
+
+
+def _float_ids(df, common_ids):
+    """
+    This method finds the ids whose abundance column isn't integer
+    :return: one flag per id
+    :rtype: numpy array of bool
+    """
+    return np.array([df[_id].dtype.kind not in 'iu' for _id in common_ids], dtype=bool)
+
+
+def _to_vocab(terms, mat, vocab):
+    """
+    This method moves the columns of a study matrix to their global term index and grows the vocabulary
+    :param terms: terms of the study matrix columns
+    :type terms: list
+    :param mat: study matrix
+    :type mat: scipy.sparse.csr_matrix
+    :param vocab: term to column index, new terms are appended in place
+    :type vocab: dict
+    :return: matrix of shape (mat.shape[0], len(vocab))
+    :rtype: scipy.sparse.csr_matrix
+    """
+    cols = np.array([vocab.setdefault(term, len(vocab)) for term in terms], dtype=np.int64)
+    mat = mat.tocoo()
+    return sparse.csr_matrix((mat.data, (mat.row, cols[mat.col])), shape=(mat.shape[0], len(vocab)),
+                             dtype=mat.dtype)
+
+
+def _read_sparse_study(studies, study_name, files_list, compact=True):
+    """
+    This method reads one study into sparse GO and taxonomy matrices with study local columns, used by pool workers.
+    The last item flags the ids with non integer GO and taxonomy columns, see _as_read
+    """
+    go_df, taxa_df = read_study(studies, study_name, files_list, compact)
+    common_ids = _common_ids(study_name, go_df, taxa_df)
+    return (study_name, common_ids, _sparse_terms(go_df, 'GO', common_ids),
+            _sparse_terms(taxa_df, '#SampleID', common_ids),
+            (_float_ids(go_df, common_ids), _float_ids(taxa_df, common_ids)))
+
+
+def _as_read(dense, present_cols, float_ids):
+    """
+    This method gives densified rows the values the row by row writer writes: integer columns as integers,
+    other columns as read, and an integer 0 for the terms the study doesn't have
+    :param dense: densified rows of a study matrix
+    :type dense: numpy array
+    :param present_cols: global column index of the study's terms
+    :type present_cols: numpy array
+    :param float_ids: flags the rows whose study column isn't integer
+    :type float_ids: numpy array of bool
+    :return: rows to write
+    :rtype: numpy array
+    """
+    if dense.dtype.kind in 'iu':
+        return dense
+    values = np.zeros(dense.shape, dtype=object)
+    values[~float_ids] = dense[~float_ids].astype(np.int64)
+    present = np.ix_(float_ids, present_cols)
+    values[present] = dense[present]
+    return values
+
+
+def _dense_blocks(study_name, ids, go_mat, taxa_mat, all_go_terms, all_taxa_terms, chunk_size, as_read=None):
+    """
+    This method densifies a study's sparse GO and taxonomy matrices chunk by chunk
+    :param as_read: if given, ((GO present columns, GO float ids), (taxonomy present columns, taxonomy float ids))
+                    and the rows get the values as read, see _as_read
+    :type as_read: tuple
+    :return: aggregated rows, at most chunk_size at a time
+    :rtype: generator of pandas dataframe
+    """
+    go_mat.resize((len(ids), len(all_go_terms)))
+    taxa_mat.resize((len(ids), len(all_taxa_terms)))
+    for start in range(0, len(ids), chunk_size):
+        end = start + chunk_size
+        go_values, taxa_values = go_mat[start:end].toarray(), taxa_mat[start:end].toarray()
+        if as_read is not None:
+            (go_cols, go_float), (taxa_cols, taxa_float) = as_read
+            go_values = _as_read(go_values, go_cols, go_float[start:end])
+            taxa_values = _as_read(taxa_values, taxa_cols, taxa_float[start:end])
+        block = pd.concat([pd.DataFrame(go_values, columns=all_go_terms),
+                           pd.DataFrame(taxa_values, columns=all_taxa_terms)], axis=1)
+        block.insert(0, 'id', ids[start:end])
+        block.insert(1, 'study_id', study_name)
+        yield block
+
+
+def generate_all_aggregated_streaming(study_dict, output_file_path, studies, chunk_size=1000, sparse_prefix=None,
+                                      n_jobs=1, parquet_path=None):
+    """
+    This method collects unique terms and generates the aggregated table while reading every study file only once.
+    Each study is kept as a sparse block while the term vocabulary grows, the wide table is written at the end.
+    Terms are ordered by first appearance in study_dict order.
+    :param study_dict: a dict contains all files of interest in each Mgnify study directory : {study: [file1, file2]}
+    :type study_dict: python dictionary
+    :param output_file_path: path to output file
+    :type output_file_path: string
+    :param studies: path to Mgnify studies
+    :type studies: string
+    :param chunk_size: number of rows densified at a time when writing
+    :type chunk_size: int
+    :param sparse_prefix: if given, also save the table in sparse format, see sparse_matrix.save_sparse_aggregated.
+                          output_file_path can be None to only write the sparse format
+    :type sparse_prefix: string
+    :param n_jobs: number of worker processes parsing studies, -1 uses all cores
+    :type n_jobs: int
+    :param parquet_path: if given, also save the table as parquet, see parquet_dataset.ParquetDatasetWriter
+    :type parquet_path: string
+    :return: all unique GO terms and taxon terms, in output column order
+    :rtype: list, list
+    """
+    go_vocab, taxa_vocab = {}, {}
+    blocks, as_read = [], []
+    # the tsv output keeps the values as read, compact dtypes are only for the sparse and parquet outputs
+    compact = output_file_path is None
+    tasks = ((studies, study_name, files_list, compact) for study_name, files_list in study_dict.items())
+    for study_name, common_ids, go_sparse, taxa_sparse, (go_float, taxa_float) in ordered_map(_read_sparse_study,
+                                                                                              tasks, n_jobs):
+        go_mat = _to_vocab(*go_sparse, go_vocab)
+        taxa_mat = _to_vocab(*taxa_sparse, taxa_vocab)
+        blocks.append((study_name, common_ids, go_mat, taxa_mat))
+        as_read.append(((np.array([go_vocab[term] for term in go_sparse[0]], dtype=np.int64), go_float),
+                        (np.array([taxa_vocab[term] for term in taxa_sparse[0]], dtype=np.int64), taxa_float)))
+
+    all_go_terms, all_taxa_terms = list(go_vocab), list(taxa_vocab)
+    if output_file_path is not None:
+        with open(output_file_path, 'w') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(['id', 'study_id'] + all_go_terms + all_taxa_terms)
+            for (study_name, common_ids, go_mat, taxa_mat), study_as_read in zip(blocks, as_read):
+                for block in _dense_blocks(study_name, common_ids, go_mat, taxa_mat, all_go_terms, all_taxa_terms,
+                                           chunk_size, study_as_read):
+                    write_block(f, block)
+    if parquet_path is not None:
+        # studies can have different compact dtypes, the parquet columns need one that holds all
+        abundance_dtype = np.result_type(*[mat.dtype for block in blocks for mat in block[2:]] or [np.int64])
+        with parquet_dataset.ParquetDatasetWriter(parquet_path, ['id', 'study_id'] + all_go_terms + all_taxa_terms,
+                                                  abundance_dtype, row_group_size=chunk_size) as writer:
+            for study_name, common_ids, go_mat, taxa_mat in blocks:
+                for block in _dense_blocks(study_name, common_ids, go_mat, taxa_mat, all_go_terms, all_taxa_terms,
+                                           chunk_size):
+                    writer.write(block)
+    if sparse_prefix is not None:
+        ids, study_ids, mats = [], [], []
+        for study_name, common_ids, go_mat, taxa_mat in blocks:
+            go_mat.resize((len(common_ids), len(all_go_terms)))
+            taxa_mat.resize((len(common_ids), len(all_taxa_terms)))
+            ids.extend(common_ids)
+            study_ids.extend([study_name] * len(common_ids))
+            mats.append(sparse.hstack([go_mat, taxa_mat], format='csr'))
+        terms = all_go_terms + all_taxa_terms
+        matrix = sparse.vstack(mats, format='csr') if mats else sparse.csr_matrix((0, len(terms)))
+        sparse_matrix.save_sparse_aggregated(sparse_prefix, ids, study_ids, terms, matrix)
+    return all_go_terms, all_taxa_terms
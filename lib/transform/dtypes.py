@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+
+# raw counts are stored in the smallest unsigned type that holds the largest count
+COUNT_DTYPES = [np.uint8, np.uint16, np.uint32, np.uint64]
+# normalized abundance values
+NORMALIZED_DTYPE = np.float32
+
+
+def count_dtype(max_value):
+    """
+    This method picks the smallest unsigned integer dtype for raw counts
+    :param max_value: the largest count
+    :type max_value: int
+    :return: one of COUNT_DTYPES
+    :rtype: numpy dtype
+    """
+    for dtype in COUNT_DTYPES:
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError("count %s doesn't fit in %s" % (max_value, COUNT_DTYPES[-1].__name__))
+
+
+def compact_dtype(values):
+    """
+    This method picks a compact dtype for abundance values. Non-negative whole numbers (raw counts, also when
+    parsed as float) get an unsigned integer dtype from count_dtype, other whole numbers the smallest signed one.
+    Anything else keeps its dtype, so values are never rounded
+    :param values: abundance values
+    :type values: numpy array
+    :return: dtype
+    :rtype: numpy dtype
+    """
+    values = np.asarray(values)
+    if values.size == 0 or values.dtype.kind not in 'uif':
+        return values.dtype
+    if values.dtype.kind == 'f' and not (np.isfinite(values).all() and (values == np.round(values)).all()):
+        return values.dtype
+    min_value, max_value = values.min(), values.max()
+    if min_value >= 0:
+        if max_value > np.iinfo(COUNT_DTYPES[-1]).max:
+            return values.dtype
+        return count_dtype(int(max_value))
+    for dtype in [np.int8, np.int16, np.int32, np.int64]:
+        if np.iinfo(dtype).min <= min_value and max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return values.dtype
+
+
+def compact_columns(df, start_col_index=0):
+    """
+    This method casts all numeric abundance columns of a table to one compact dtype (see compact_dtype).
+    Non-numeric columns in the abundance range, e.g. 'biome' in the labelled table, are left as they are
+    :param df: data table, abundance columns start at start_col_index
+    :type df: pandas dataframe
+    :param start_col_index: the index of the first abundance column
+    :type start_col_index: int
+    :return: table with compact abundance columns
+    :rtype: pandas dataframe
+    """
+    columns = [col for col, col_dtype in df.dtypes.iloc[start_col_index:].items() if col_dtype.kind in 'uif']
+    if len(columns) == 0:
+        return df
+    dtype = np.result_type(*[compact_dtype(df[col].to_numpy()) for col in columns])
+    if (df.dtypes[columns] == dtype).all():
+        return df
+    return df.astype({col: dtype for col in columns})
+
+
+def normalized(values):
+    """
+    This method casts normalized abundance values to NORMALIZED_DTYPE
+    :param values: normalized values
+    :type values: numpy array
+    :return: values in NORMALIZED_DTYPE, not copied if already
+    :rtype: numpy array
+    """
+    return np.asarray(values, dtype=NORMALIZED_DTYPE)
+
+
+def read_abundance_tsv(path, start_col_index=1, **kwargs):
+    """
+    This method reads a tsv table and casts its abundance columns to one compact dtype
+    :param path: tsv path
+    :type path: string
+    :param start_col_index: the index of the first abundance column
+    :type start_col_index: int
+    :param kwargs: other pandas.read_csv arguments
+    :return: data table
+    :rtype: pandas dataframe
+    """
+    return compact_columns(pd.read_csv(path, sep='\t', **kwargs), start_col_index)
@@ -1,6 +1,11 @@
 import csv
+import io
 import json
 import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
 from tqdm.notebook import tqdm
 
 
@@ -22,7 +27,7 @@ def read_analyses_json(studies_dir_path, study, id_type):
         # get run_id or assembly_id
         try:
             _id = data['relationships'][id_type]['data']['id']
-        except KeyError:
+        except (KeyError, TypeError):  # TypeError: relationship data is null
             continue
 
         # get experiment type
@@ -67,7 +72,91 @@ def read_samples_json(studies_dir_path, study):
     return samples_hash
 
 
-def write_new_file(studies_dir_path, input_file, output_file, row_count):
+def _id_type(_id):
+    """
+    This method determines the id type from its prefix
+    :return: 'run', 'assembly' or None if the id is neither
+    :rtype: string
+    """
+    if _id.startswith("SRR") or _id.startswith("ERR"):
+        return 'run'
+    elif _id.startswith("ERZ"):
+        return 'assembly'
+    return None
+
+
+def build_metadata_index(studies_dir_path, index_path, studies=None):
+    """
+    This method compiles analyses.json and samples.json of all studies into one SQLite file, so joining biome
+    to the aggregated table needs no JSON parsing. Both run ids and assembly ids of every analysis are indexed.
+    :param studies_dir_path: path to Mgnify studies
+    :type studies_dir_path: string
+    :param index_path: output SQLite file path, an existing file is replaced
+    :type index_path: string
+    :param studies: study directories to index, None indexes every directory with analyses.json and samples.json
+    :type studies: list
+    :return: None
+    """
+    if studies is None:
+        studies = sorted(study for study in os.listdir(studies_dir_path)
+                         if os.path.exists(os.path.join(studies_dir_path, study, 'analyses.json'))
+                         and os.path.exists(os.path.join(studies_dir_path, study, 'samples.json')))
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    with sqlite3.connect(index_path) as conn:
+        conn.execute("CREATE TABLE analyses (study_id TEXT, id_type TEXT, id TEXT, sample_id TEXT, exptype TEXT, "
+                     "PRIMARY KEY (study_id, id_type, id))")
+        conn.execute("CREATE TABLE samples (study_id TEXT, sample_id TEXT, biome TEXT, "
+                     "PRIMARY KEY (study_id, sample_id))")
+        for study in tqdm(studies):
+            for id_type in ['run', 'assembly']:
+                analyses_hash = read_analyses_json(studies_dir_path, study, id_type)
+                conn.executemany("INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?)",
+                                 [(study, id_type, _id, item['sample_id'], item['exptype'])
+                                  for _id, item in analyses_hash.items()])
+            samples_hash = read_samples_json(studies_dir_path, study)
+            conn.executemany("INSERT OR REPLACE INTO samples VALUES (?, ?, ?)",
+                             [(study, sample_id, biome) for sample_id, biome in samples_hash.items()])
+    conn.close()
+
+
+def lookup_metadata(conn, study_id, _id):
+    """
+    This method looks up sample id, biome and experiment type of a run/assembly id in a metadata index
+    :param conn: connection to a file built by build_metadata_index
+    :type conn: sqlite3.Connection
+    :param study_id: study id
+    :type study_id: string
+    :param _id: run id or assembly id
+    :type _id: string
+    :return: (sample_id, biome, exptype), sample_id is None if the id has no sample, biome is None if the
+             sample has no biome
+    :rtype: tuple
+    """
+    res = conn.execute("SELECT a.sample_id, s.biome, a.exptype FROM analyses a LEFT JOIN samples s "
+                       "ON s.study_id = a.study_id AND s.sample_id = a.sample_id "
+                       "WHERE a.study_id = ? AND a.id_type = ? AND a.id = ?",
+                       (study_id, _id_type(_id), _id)).fetchone()
+    return res if res is not None else (None, None, None)
+
+
+def write_new_file(studies_dir_path, input_file, output_file, row_count, index_path=None):
+    """
+    This method inserts sample_id, biome and exptype columns after id and study_id of the aggregated table.
+    Rows without sample id or biome are removed.
+    :param studies_dir_path: path to Mgnify studies
+    :type studies_dir_path: string
+    :param input_file: aggregated tsv
+    :type input_file: string
+    :param output_file: output tsv
+    :type output_file: string
+    :param row_count: number of rows to process
+    :type row_count: int
+    :param index_path: metadata index built by build_metadata_index. If None, study json files are read on demand
+    :type index_path: string
+    :return: None
+    """
+    conn = sqlite3.connect(index_path) if index_path is not None else None
     with open(input_file, 'r') as f_in:
         with open(output_file, 'w') as f_out:
             reader = csv.reader(f_in, delimiter="\t")
@@ -82,38 +171,132 @@ def write_new_file(studies_dir_path, input_file, output_file, row_count):
             for _ in tqdm(range(row_count)):
                 row = next(reader)
                 _id, study_id = row[0], row[1]
-                if _id.startswith("SRR") or _id.startswith("ERR") or _id.startswith("ERZ"):
-                    # determine the id type, run_id or assembly_id
-                    if _id.startswith("SRR") or _id.startswith("ERR"):
-                        id_type = 'run'
-                    else:
-                        id_type = 'assembly'
-
-                    # if the stuty study_hash has been created, use it directly
-                    if study_id in study_hash:
-                        analyses_hash = study_hash[study_id]['analyses_hash']
-                        samples_hash = study_hash[study_id]['samples_hash']
-                    else:
-                        analyses_hash = read_analyses_json(studies_dir_path, study_id, id_type)
-                        samples_hash = read_samples_json(studies_dir_path, study_id)
-                        study_hash[study_id] = {}
-                        study_hash[study_id]['analyses_hash'] = analyses_hash
-                        study_hash[study_id]['samples_hash'] = samples_hash
-
-                    # try to extract the sample_id from analyses_hash, and write to new file
-                    try:
+                # determine the id type, run_id or assembly_id
+                id_type = _id_type(_id)
+                if id_type is None:
+                    continue
+
+                if conn is not None:
+                    sample_id, biome, exp_type = lookup_metadata(conn, study_id, _id)
+                else:
+                    # if the study_hash has been created, use it directly. Analyses are cached per id type,
+                    # a study can have both run and assembly rows
+                    if study_id not in study_hash:
+                        study_hash[study_id] = {'samples_hash': read_samples_json(studies_dir_path, study_id)}
+                    if id_type not in study_hash[study_id]:
+                        study_hash[study_id][id_type] = read_analyses_json(studies_dir_path, study_id, id_type)
+                    analyses_hash = study_hash[study_id][id_type]
+                    samples_hash = study_hash[study_id]['samples_hash']
+                    sample_id, exp_type = None, None
+                    if _id in analyses_hash:
                         sample_id = analyses_hash[_id]['sample_id']
-                    except KeyError:
-                        print("{}({}) doesn't have sample id, removed from input file".format(id_type, _id))
-                        continue
-
-                    exp_type = analyses_hash[_id]['exptype']
-                    try:
-                        biome = samples_hash[sample_id]
-                    except KeyError:
-                        print("{}({}) doesn't have biome, removed from input file".format(id_type, _id))
-                        continue
-                    row.insert(2, sample_id)
-                    row.insert(3, biome)
-                    row.insert(4, exp_type)
-                    writer.writerow(row)
+                        exp_type = analyses_hash[_id]['exptype']
+                    biome = samples_hash.get(sample_id)
+
+                # write to new file only when both sample_id and biome are found
+                if sample_id is None:
+                    print("{}({}) doesn't have sample id, removed from input file".format(id_type, _id))
+                    continue
+                if biome is None:
+                    print("{}({}) doesn't have biome, removed from input file".format(id_type, _id))
+                    continue
+                row.insert(2, sample_id)
+                row.insert(3, biome)
+                row.insert(4, exp_type)
+                writer.writerow(row)
+    if conn is not None:
+        conn.close()
+
+
+def _metadata_table(studies_dir_path, study_ids, index_path=None):
+    """
+    This method collects sample id, biome and experiment type of all analyses of the given studies
+    :param studies_dir_path: path to Mgnify studies
+    :type studies_dir_path: string
+    :param study_ids: studies of interest
+    :type study_ids: list
+    :param index_path: metadata index built by build_metadata_index. If None, study json files are read
+    :type index_path: string
+    :return: table with columns ['study_id', 'id_type', 'id', 'sample_id', 'biome', 'exptype'], biome is NaN if
+             the sample has no biome
+    :rtype: pandas dataframe
+    """
+    if index_path is not None:
+        with sqlite3.connect(index_path) as conn:
+            metadata = pd.read_sql_query("SELECT a.study_id, a.id_type, a.id, a.sample_id, s.biome, a.exptype "
+                                         "FROM analyses a LEFT JOIN samples s "
+                                         "ON s.study_id = a.study_id AND s.sample_id = a.sample_id", conn)
+        conn.close()
+        return metadata[metadata['study_id'].isin(study_ids)]
+    records = []
+    for study in study_ids:
+        samples_hash = read_samples_json(studies_dir_path, study)
+        for id_type in ['run', 'assembly']:
+            for _id, item in read_analyses_json(studies_dir_path, study, id_type).items():
+                records.append((study, id_type, _id, item['sample_id'], samples_hash.get(item['sample_id']),
+                                item['exptype']))
+    return pd.DataFrame(records, columns=['study_id', 'id_type', 'id', 'sample_id', 'biome', 'exptype'])
+
+
+def _tsv_fields(fields):
+    """
+    This method serializes fields the way csv.writer does, without line terminator
+    """
+    buf = io.StringIO()
+    csv.writer(buf, delimiter='\t', lineterminator='').writerow(fields)
+    return buf.getvalue()
+
+
+def join_biome(studies_dir_path, input_file, output_file, index_path=None, sidecar=False):
+    """
+    This method adds sample_id, biome and exptype to the aggregated table like write_new_file, but joins them as
+    a small table on id. Only id and study_id are parsed, the feature values of each row are copied untouched.
+    :param studies_dir_path: path to Mgnify studies
+    :type studies_dir_path: string
+    :param input_file: aggregated tsv
+    :type input_file: string
+    :param output_file: output tsv
+    :type output_file: string
+    :param index_path: metadata index built by build_metadata_index. If None, study json files are read once
+    :type index_path: string
+    :param sidecar: if true, output_file only has columns ['row', 'id', 'study_id', 'sample_id', 'biome',
+                    'exptype'] for the kept rows, row is the 0-based data row number in input_file
+    :type sidecar: boolean
+    :return: number of rows kept
+    :rtype: int
+    """
+    keys = pd.read_csv(input_file, sep='\t', usecols=[0, 1], dtype=str, keep_default_na=False,
+                       skip_blank_lines=False)
+    keys.columns = ['id', 'study_id']
+    keys['id_type'] = np.select([keys['id'].str.startswith(('SRR', 'ERR')), keys['id'].str.startswith('ERZ')],
+                                ['run', 'assembly'], default='')
+    metadata = _metadata_table(studies_dir_path, list(keys['study_id'].unique()), index_path)
+    joined = keys.merge(metadata, how='left', on=['study_id', 'id_type', 'id'], validate='many_to_one')
+
+    # report removed rows the same way as write_new_file
+    has_type = joined['id_type'] != ''
+    for id_type, _id in joined.loc[has_type & joined['sample_id'].isna(), ['id_type', 'id']].itertuples(index=False):
+        print("{}({}) doesn't have sample id, removed from input file".format(id_type, _id))
+    for id_type, _id in joined.loc[has_type & joined['sample_id'].notna() & joined['biome'].isna(),
+                                   ['id_type', 'id']].itertuples(index=False):
+        print("{}({}) doesn't have biome, removed from input file".format(id_type, _id))
+    kept = (has_type & joined['sample_id'].notna() & joined['biome'].notna()).to_numpy()
+
+    if sidecar:
+        res = joined.loc[kept, ['id', 'study_id', 'sample_id', 'biome', 'exptype']]
+        res.insert(0, 'row', np.flatnonzero(kept))
+        res.to_csv(output_file, sep='\t', index=False)
+        return int(kept.sum())
+
+    prefixes = [_tsv_fields(fields) for fields in
+                joined.loc[kept, ['id', 'study_id', 'sample_id', 'biome', 'exptype']].itertuples(index=False)]
+    # newline='' keeps each line's original terminator
+    with open(input_file, 'r', newline='') as f_in, open(output_file, 'w', newline='') as f_out:
+        header = f_in.readline()
+        first_cols = header.split('\t', 2)
+        f_out.write('\t'.join(first_cols[:2] + ['sample_id', 'biome', 'exptype', first_cols[2]]))
+        prefixes = iter(prefixes)
+        for keep, line in zip(kept, f_in):
+            if keep:
+                f_out.write(next(prefixes) + '\t' + line.split('\t', 2)[2])
+    return int(kept.sum())
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from scipy import sparse
+
+if __package__:
+    from . import aggregate
+    from . import sparse_matrix
+else:
+    # run from the transform folder, e.g. by transform_test
+    import aggregate
+    import sparse_matrix
+
+
+def _manifest_path(prefix):
+    return prefix + '_manifest.json'
+
+
+def _file_state(tsv_path, use_hash):
+    """
+    This method describes a study file so changes can be detected
+    :return: {'size': bytes, 'mtime': modification time} plus 'md5' if use_hash
+    :rtype: dict
+    """
+    stat = os.stat(tsv_path)
+    state = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if use_hash:
+        md5 = hashlib.md5()
+        with open(tsv_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        state['md5'] = md5.hexdigest()
+    return state
+
+
+def _unchanged(old_states, new_states, use_hash):
+    """
+    This method compares recorded and current file states of a study. With use_hash, size and md5 must match,
+    otherwise size and modification time
+    """
+    if old_states is None or set(old_states) != set(new_states):
+        return False
+    keys = ['size', 'md5'] if use_hash else ['size', 'mtime']
+    return all(old_states[file].get(key) == new_states[file][key] for file in new_states for key in keys)
+
+
+def load_manifest(prefix):
+    """
+    This method loads the manifest of an incrementally built sparse aggregated table
+    :param prefix: path prefix of the sparse aggregated table
+    :type prefix: string
+    :return: {'go_terms': list, 'taxa_terms': list, 'studies': {study: {file: file state}}}, empty if not built yet
+    :rtype: dict
+    """
+    if not os.path.exists(_manifest_path(prefix)):
+        return {'go_terms': [], 'taxa_terms': [], 'studies': {}}
+    with open(_manifest_path(prefix)) as f:
+        return json.load(f)
+
+
+def _widen(matrix, n_go_old, n_go, n_taxa):
+    """
+    This method inserts zero columns for new GO terms after the old GO columns and new taxon terms at the end
+    :param matrix: table with n_go_old GO columns followed by taxon columns
+    :type matrix: scipy.sparse.csr_matrix
+    :return: matrix of shape (matrix.shape[0], n_go + n_taxa)
+    :rtype: scipy.sparse.csr_matrix
+    """
+    indices = matrix.indices.astype(np.int64)
+    indices[indices >= n_go_old] += n_go - n_go_old
+    return sparse.csr_matrix((matrix.data, indices, matrix.indptr), shape=(matrix.shape[0], n_go + n_taxa))
+
+
+def update_aggregated(study_dict, studies, prefix, use_hash=False, n_jobs=1):
+    """
+    This method incrementally updates a sparse aggregated table (see sparse_matrix) with new or changed studies.
+    A manifest next to the table records every processed study file and the GO and taxonomy vocabularies.
+    Studies whose files are unchanged are not read. Rows of changed studies are replaced and moved to the end,
+    rows of new studies are appended. New terms are added as zero filled columns, GO terms before taxon terms,
+    and studies not in study_dict are kept as they are.
+    :param study_dict: a dict contains all files of interest in each Mgnify study directory : {study: [file1, file2]}
+    :type study_dict: python dictionary
+    :param studies: path to Mgnify studies
+    :type studies: string
+    :param prefix: path prefix of the sparse aggregated table, created if it doesn't exist
+    :type prefix: string
+    :param use_hash: if true, compare size and md5 of study files, otherwise size and modification time
+    :type use_hash: boolean
+    :param n_jobs: number of worker processes parsing studies, -1 uses all cores
+    :type n_jobs: int
+    :return: names of the studies that were (re)processed
+    :rtype: list
+    """
+    manifest = load_manifest(prefix)
+    states = {study_name: {file: _file_state(os.path.join(studies, study_name, file), use_hash)
+                           for file in files_list}
+              for study_name, files_list in study_dict.items()}
+    changed = [study_name for study_name in study_dict
+               if not _unchanged(manifest['studies'].get(study_name), states[study_name], use_hash)]
+    if not changed and os.path.exists(_manifest_path(prefix)):
+        return []
+
+    go_vocab = {term: i for i, term in enumerate(manifest['go_terms'])}
+    taxa_vocab = {term: i for i, term in enumerate(manifest['taxa_terms'])}
+    n_go_old = len(go_vocab)
+    ids, study_ids, blocks = [], [], []
+    tasks = ((studies, study_name, study_dict[study_name]) for study_name in changed)
+    for study_name, common_ids, go_sparse, taxa_sparse, _ in aggregate.ordered_map(aggregate._read_sparse_study,
+                                                                                   tasks, n_jobs):
+        blocks.append((aggregate._to_vocab(*go_sparse, go_vocab), aggregate._to_vocab(*taxa_sparse, taxa_vocab)))
+        ids.extend(common_ids)
+        study_ids.extend([study_name] * len(common_ids))
+    n_go, n_taxa = len(go_vocab), len(taxa_vocab)
+
+    mats = []
+    if manifest['studies']:
+        matrix, rows, _ = sparse_matrix.load_sparse_aggregated(prefix)
+        keep = ~rows['study_id'].isin(changed).to_numpy()
+        mats.append(_widen(matrix[keep], n_go_old, n_go, n_taxa))
+        ids = list(rows['id'][keep]) + ids
+        study_ids = list(rows['study_id'][keep]) + study_ids
+    for go_mat, taxa_mat in blocks:
+        go_mat.resize((go_mat.shape[0], n_go))
+        taxa_mat.resize((taxa_mat.shape[0], n_taxa))
+        mats.append(sparse.hstack([go_mat, taxa_mat], format='csr'))
+    matrix = sparse.vstack(mats, format='csr') if mats else sparse.csr_matrix((0, n_go + n_taxa))
+    terms = list(go_vocab) + list(taxa_vocab)
+    sparse_matrix.save_sparse_aggregated(prefix, ids, study_ids, terms, matrix)
+
+    manifest['go_terms'], manifest['taxa_terms'] = list(go_vocab), list(taxa_vocab)
+    manifest['studies'].update({study_name: states[study_name] for study_name in changed})
+    with open(_manifest_path(prefix), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return changed
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+# columns stored as strings, every other column is an abundance column
+META_COLUMNS = ['id', 'study_id', 'sample_id', 'biome', 'exptype']
+
+
+class ParquetDatasetWriter:
+    def __init__(self, path, columns, abundance_dtype=None, row_group_size=10000):
+        """
+        Writes an aggregated table to a parquet file block by block
+        :param path: output parquet file path
+        :type path: string
+        :param columns: all column names in order, metadata columns are any of META_COLUMNS
+        :type columns: list
+        :param abundance_dtype: numpy dtype of abundance columns, e.g. 'uint32' or 'float32'.
+                                If None, it is taken from the first written block, later blocks must fit in it
+        :type abundance_dtype: string or numpy dtype
+        :param row_group_size: maximum number of rows in a row group, the unit of row pruning when reading
+        :type row_group_size: int
+        """
+        self.path = path
+        self.columns = list(columns)
+        self.abundance_dtype = abundance_dtype
+        self.row_group_size = row_group_size
+        self.schema = None
+        self.writer = None
+
+    def _open(self, block=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self.abundance_dtype is None:
+            abundance_cols = [col for col in self.columns if col not in META_COLUMNS]
+            if block is not None and abundance_cols:
+                self.abundance_dtype = np.result_type(*block[abundance_cols].dtypes)
+            else:
+                self.abundance_dtype = np.int64
+        abundance_type = pa.from_numpy_dtype(np.dtype(self.abundance_dtype))
+        self.schema = pa.schema([(col, pa.string() if col in META_COLUMNS else abundance_type)
+                                 for col in self.columns])
+        self.writer = pq.ParquetWriter(self.path, self.schema)
+
+    def write(self, block):
+        """
+        This method appends rows to the parquet file
+        :param block: rows with exactly self.columns
+        :type block: pandas dataframe
+        :return: None
+        """
+        if list(block.columns) != self.columns:
+            raise ValueError("block columns don't match the dataset columns")
+        import pyarrow as pa
+        if self.writer is None:
+            self._open(block)
+        try:
+            table = pa.Table.from_pandas(block, schema=self.schema, preserve_index=False, safe=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError("block values don't fit abundance_dtype {}, pass an abundance_dtype that holds all "
+                             "values, e.g. 'float64': {}".format(np.dtype(self.abundance_dtype), e)) from e
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+
+    def close(self):
+        if self.writer is None:
+            self._open()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_parquet_dataset(df, path, abundance_dtype=None, row_group_size=10000):
+    """
+    This method writes an aggregated table held in memory to a parquet file
+    :param df: aggregated table, metadata columns are any of META_COLUMNS, the rest are abundance columns
+    :type df: pandas dataframe
+    :param path: output parquet file path
+    :type path: string
+    :param abundance_dtype: numpy dtype of abundance columns, None keeps the table's own dtype
+    :type abundance_dtype: string or numpy dtype
+    :param row_group_size: maximum number of rows in a row group
+    :type row_group_size: int
+    :return: None
+    """
+    with ParquetDatasetWriter(path, df.columns, abundance_dtype, row_group_size) as writer:
+        writer.write(df)
+
+
+def tsv_to_parquet(input_file, path, abundance_dtype=None, chunksize=10000, row_group_size=10000):
+    """
+    This method converts an aggregated tsv (output of generate_all_aggregated or write_new_file) to parquet,
+    parsing chunksize rows at a time
+    :param input_file: aggregated tsv path
+    :type input_file: string
+    :param path: output parquet file path
+    :type path: string
+    :param abundance_dtype: numpy dtype of abundance columns, None takes the dtype holding the values of all chunks,
+                            at the cost of parsing the file twice
+    :type abundance_dtype: string or numpy dtype
+    :param chunksize: number of rows parsed at a time
+    :type chunksize: int
+    :param row_group_size: maximum number of rows in a row group
+    :type row_group_size: int
+    :return: None
+    """
+    header = pd.read_csv(input_file, sep='\t', nrows=0).columns
+    meta_dtypes = {col: str for col in header if col in META_COLUMNS}
+    abundance_cols = [col for col in header if col not in META_COLUMNS]
+    if abundance_dtype is None and abundance_cols:
+        # a fractional value in any chunk makes the whole column float
+        chunk_dtypes = [np.result_type(*chunk.dtypes)
+                        for chunk in pd.read_csv(input_file, sep='\t', chunksize=chunksize, usecols=abundance_cols)]
+        abundance_dtype = np.result_type(*chunk_dtypes) if chunk_dtypes else np.int64
+    with ParquetDatasetWriter(path, header, abundance_dtype, row_group_size) as writer:
+        for chunk in pd.read_csv(input_file, sep='\t', chunksize=chunksize, dtype=meta_dtypes):
+            writer.write(chunk)
+
+
+def parquet_columns(path):
+    """
+    This method lists metadata and abundance columns of a parquet dataset without reading any data
+    :param path: parquet file path
+    :type path: string
+    :return: metadata columns, abundance columns
+    :rtype: list, list
+    """
+    import pyarrow.parquet as pq
+    names = pq.read_schema(path).names
+    return [col for col in names if col in META_COLUMNS], [col for col in names if col not in META_COLUMNS]
+
+
+def read_parquet_dataset(path, features=None, metadata=None, filters=None):
+    """
+    This method reads part of a parquet dataset. Only the requested columns are read, and row groups whose
+    statistics can't match filters are skipped
+    :param path: parquet file path
+    :type path: string
+    :param features: abundance columns to read, None reads all
+    :type features: list
+    :param metadata: metadata columns to read, None reads all present in the dataset
+    :type metadata: list
+    :param filters: pyarrow row filters, e.g. [('biome', 'in', ['root:Mixed'])] or [('study_id', '==', 'study1')]
+    :type filters: list
+    :return: table with metadata columns first, then abundance columns
+    :rtype: pandas dataframe
+    """
+    import pyarrow.parquet as pq
+    meta_cols, abundance_cols = parquet_columns(path)
+    if metadata is not None:
+        meta_cols = [col for col in meta_cols if col in metadata]
+    if features is not None:
+        abundance_cols = list(features)
+    return pq.read_table(path, columns=meta_cols + abundance_cols, filters=filters).to_pandas()
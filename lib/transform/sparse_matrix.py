@@ -0,0 +1,99 @@
+import csv
+
+import pandas as pd
+from scipy import sparse
+
+
+def _paths(prefix):
+    """
+    This method returns the matrix, row index and column index file paths of a sparse aggregated table
+    :param prefix: path prefix, e.g. "output/aggregated"
+    :type prefix: string
+    :return: "<prefix>.npz", "<prefix>_rows.tsv", "<prefix>_columns.tsv"
+    :rtype: string, string, string
+    """
+    return prefix + '.npz', prefix + '_rows.tsv', prefix + '_columns.tsv'
+
+
+def save_sparse_aggregated(prefix, ids, study_ids, terms, matrix):
+    """
+    This method saves the aggregated GO + taxonomy table as a CSR matrix plus row and column index files
+    :param prefix: path prefix of the three output files
+    :type prefix: string
+    :param ids: run/assembly id of every row
+    :type ids: list
+    :param study_ids: study id of every row
+    :type study_ids: list
+    :param terms: GO and taxon terms in column order
+    :type terms: list
+    :param matrix: abundance matrix of shape (len(ids), len(terms))
+    :type matrix: scipy sparse matrix
+    :return: None
+    """
+    if matrix.shape != (len(ids), len(terms)):
+        raise ValueError("matrix shape %s doesn't match %d rows and %d terms" % (matrix.shape, len(ids), len(terms)))
+    matrix_path, rows_path, columns_path = _paths(prefix)
+    matrix = sparse.csr_matrix(matrix)
+    matrix.eliminate_zeros()
+    sparse.save_npz(matrix_path, matrix)
+    pd.DataFrame({'id': ids, 'study_id': study_ids}).to_csv(rows_path, sep='\t', index=False)
+    with open(columns_path, 'w') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerows([term] for term in terms)
+
+
+def load_sparse_aggregated(prefix):
+    """
+    This method loads the files written by save_sparse_aggregated
+    :param prefix: path prefix of the three files
+    :type prefix: string
+    :return: abundance matrix, row index table with columns ['id', 'study_id'], terms in column order
+    :rtype: scipy.sparse.csr_matrix, pandas dataframe, list
+    """
+    matrix_path, rows_path, columns_path = _paths(prefix)
+    matrix = sparse.load_npz(matrix_path).tocsr()
+    rows = pd.read_csv(rows_path, sep='\t', dtype=str, keep_default_na=False)
+    with open(columns_path) as f:
+        terms = [row[0] for row in csv.reader(f, delimiter='\t')]
+    return matrix, rows, terms
+
+
+def load_sparse_aggregated_df(prefix, dense=False):
+    """
+    This method loads a sparse aggregated table with the same layout as the aggregated tsv
+    :param prefix: path prefix of the three files
+    :type prefix: string
+    :param dense: if true, abundance columns are plain numpy columns, otherwise pandas sparse columns filled with 0
+    :type dense: boolean
+    :return: table with columns ['id', 'study_id'] + terms
+    :rtype: pandas dataframe
+    """
+    matrix, rows, terms = load_sparse_aggregated(prefix)
+    if dense:
+        values = pd.DataFrame(matrix.toarray(), columns=terms)
+    else:
+        values = pd.DataFrame.sparse.from_spmatrix(matrix, columns=terms)
+    return pd.concat([rows, values], axis=1)
+
+
+def aggregated_tsv_to_sparse(input_file, prefix, chunksize=1000):
+    """
+    This method converts an aggregated tsv into the sparse format, reading chunksize rows at a time
+    :param input_file: aggregated tsv, first two columns are 'id' and 'study_id'
+    :type input_file: string
+    :param prefix: path prefix of the three output files
+    :type prefix: string
+    :param chunksize: number of rows parsed at a time
+    :type chunksize: int
+    :return: None
+    """
+    ids, study_ids, blocks = [], [], []
+    terms = None
+    for chunk in pd.read_csv(input_file, sep='\t', chunksize=chunksize, dtype={'id': str, 'study_id': str}):
+        terms = list(chunk.columns[2:])
+        ids.extend(chunk['id'])
+        study_ids.extend(chunk['study_id'])
+        blocks.append(sparse.csr_matrix(chunk.iloc[:, 2:].to_numpy()))
+    if terms is None:
+        raise ValueError("%s has no rows" % input_file)
+    save_sparse_aggregated(prefix, ids, study_ids, terms, sparse.vstack(blocks, format='csr'))
@@ -1,7 +1,17 @@
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
 import filecmp
 import aggregate as agg
+import dtypes
 import extract_biome as eb
+import incremental as inc
+import numpy as np
+import pandas as pd
+import parquet_dataset as pqd
+import sparse_matrix as sm
 
 
 class MyTestCase(unittest.TestCase):
@@ -17,6 +27,175 @@ class MyTestCase(unittest.TestCase):
         agg.generate_all_aggregated(study_dict, 'data/output/test.tsv', studies, all_go_terms, all_taxa_terms)
         self.assertTrue(filecmp.cmp('data/output/test.tsv', 'data/output/target.tsv'))
 
+    def test_generate_all_aggregated_pivot(self):
+        study_dict = {'study1': ['ERP104187_GO_abundances_v4.1.tsv', 'ERP104187_taxonomy_abundances_SSU_v4.1.tsv'],
+                      'study2': ['ERP104188_GO_abundances_v4.1.tsv', 'ERP104188_taxonomy_abundances_SSU_v4.1.tsv']}
+
+        studies = 'data/studies'
+
+        all_go_terms = ['go1', 'go2', 'go3', 'go4']
+        all_taxa_terms = ['taxa1', 'taxa2', 'taxa3', 'taxa4']
+
+        agg.generate_all_aggregated(study_dict, 'data/output/test.tsv', studies, all_go_terms, all_taxa_terms,
+                                    engine="pivot")
+        self.assertTrue(filecmp.cmp('data/output/test.tsv', 'data/output/target.tsv', shallow=False))
+
+    def test_generate_all_aggregated_parallel(self):
+        study_dict = {'study1': ['ERP104187_GO_abundances_v4.1.tsv', 'ERP104187_taxonomy_abundances_SSU_v4.1.tsv'],
+                      'study2': ['ERP104188_GO_abundances_v4.1.tsv', 'ERP104188_taxonomy_abundances_SSU_v4.1.tsv']}
+
+        all_go_terms = ['go1', 'go2', 'go3', 'go4']
+        all_taxa_terms = ['taxa1', 'taxa2', 'taxa3', 'taxa4']
+
+        agg.generate_all_aggregated(study_dict, 'data/output/test.tsv', 'data/studies', all_go_terms, all_taxa_terms,
+                                    engine="pivot", n_jobs=2)
+        self.assertTrue(filecmp.cmp('data/output/test.tsv', 'data/output/target.tsv', shallow=False))
+
+        agg.generate_all_aggregated_streaming(study_dict, 'data/output/test.tsv', 'data/studies', n_jobs=2)
+        self.assertTrue(filecmp.cmp('data/output/test.tsv', 'data/output/target.tsv', shallow=False))
+
+    def test_generate_all_aggregated_streaming(self):
+        study_dict = {'study1': ['ERP104187_GO_abundances_v4.1.tsv', 'ERP104187_taxonomy_abundances_SSU_v4.1.tsv'],
+                      'study2': ['ERP104188_GO_abundances_v4.1.tsv', 'ERP104188_taxonomy_abundances_SSU_v4.1.tsv']}
+
+        all_go_terms, all_taxa_terms = agg.generate_all_aggregated_streaming(study_dict, 'data/output/test.tsv',
+                                                                             'data/studies', chunk_size=1)
+        self.assertEqual(all_go_terms, ['go1', 'go2', 'go3', 'go4'])
+        self.assertEqual(all_taxa_terms, ['taxa1', 'taxa2', 'taxa3', 'taxa4'])
+        self.assertTrue(filecmp.cmp('data/output/test.tsv', 'data/output/target.tsv', shallow=False))
+
+    def test_generate_all_aggregated_mixed_dtypes(self):
+        # every engine writes the values as read and missing terms as 0
+        study_dict = {'study1': ['ERP104187_GO_abundances_v4.1.tsv', 'ERP104187_taxonomy_abundances_SSU_v4.1.tsv'],
+                      'study2': ['ERP104188_GO_abundances_v4.1.tsv', 'ERP104188_taxonomy_abundances_SSU_v4.1.tsv']}
+        run_cols = {
+            # one fractional value in one run column
+            'mixed': (['SRRid2'], ['SRRid2\tstudy1\t0.5\t3.0\t1.0\t0\t', 'SRRid3\tstudy1\t2\t0\t4\t0\t']),
+            # every run column is float
+            'float': (['SRRid1', 'SRRid2', 'SRRid3', 'SRRid4'], ['SRRid3\tstudy1\t2.0\t0.0\t4.0\t0\t'])}
+        for case, (float_cols, expected_rows) in run_cols.items():
+            with self.subTest(case), tempfile.TemporaryDirectory() as tmp:
+                studies = os.path.join(tmp, 'studies')
+                for study_name in study_dict:
+                    shutil.copytree(os.path.join('data/studies', study_name), os.path.join(studies, study_name))
+                go_path = os.path.join(studies, 'study1', study_dict['study1'][0])
+                go_df = pd.read_csv(go_path, sep='\t')
+                go_df[float_cols] = go_df[float_cols].astype(float)
+                if case == 'mixed':
+                    go_df.loc[0, 'SRRid2'] = 0.5
+                go_df.to_csv(go_path, sep='\t', index=False)
+
+                all_go_terms = ['go1', 'go2', 'go3', 'go4']
+                all_taxa_terms = ['taxa1', 'taxa2', 'taxa3', 'taxa4']
+                loop_path, pivot_path = os.path.join(tmp, 'loop.tsv'), os.path.join(tmp, 'pivot.tsv')
+                agg.generate_all_aggregated(study_dict, loop_path, studies, all_go_terms, all_taxa_terms)
+                agg.generate_all_aggregated(study_dict, pivot_path, studies, all_go_terms, all_taxa_terms,
+                                            engine="pivot")
+                self.assertTrue(filecmp.cmp(loop_path, pivot_path, shallow=False))
+                streaming_path = os.path.join(tmp, 'streaming.tsv')
+                self.assertEqual(agg.generate_all_aggregated_streaming(study_dict, streaming_path, studies,
+                                                                       chunk_size=2), (all_go_terms, all_taxa_terms))
+                self.assertTrue(filecmp.cmp(loop_path, streaming_path, shallow=False))
+                with open(loop_path) as f:
+                    rows = f.read().splitlines()
+                for expected_row in expected_rows:
+                    self.assertTrue(any(row.startswith(expected_row) for row in rows), expected_row)
+
+    def test_sparse_aggregated(self):
+        study_dict = {'study1': ['ERP104187_GO_abundances_v4.1.tsv', 'ERP104187_taxonomy_abundances_SSU_v4.1.tsv'],
+                      'study2': ['ERP104188_GO_abundances_v4.1.tsv', 'ERP104188_taxonomy_abundances_SSU_v4.1.tsv']}
+        target = pd.read_csv('data/output/target.tsv', sep='\t')
+
+        agg.generate_all_aggregated_streaming(study_dict, None, 'data/studies', sparse_prefix='data/output/test')
+        matrix, rows, terms = sm.load_sparse_aggregated('data/output/test')
+        self.assertEqual(matrix.nnz, (target.iloc[:, 2:].to_numpy() != 0).sum())
+        self.assertEqual(terms, list(target.columns[2:]))
+        res = sm.load_sparse_aggregated_df('data/output/test', dense=True)
+        self.assertTrue((res.iloc[:, 2:].dtypes == 'uint8').all())
+        pd.testing.assert_frame_equal(res, target, check_dtype=False)
+        sparse_df = sm.load_sparse_aggregated_df('data/output/test')
+        pd.testing.assert_frame_equal(sparse_df.iloc[:, 2:].sparse.to_dense(), target.iloc[:, 2:], check_dtype=False)
+
+        sm.aggregated_tsv_to_sparse('data/output/target.tsv', 'data/output/test', chunksize=2)
+        self.assertTrue(sm.load_sparse_aggregated_df('data/output/test', dense=True).equals(target))
+        for path in ['data/output/test.npz', 'data/output/test_rows.tsv', 'data/output/test_columns.tsv']:
+            os.remove(path)
+
+    def test_parquet_dataset(self):
+        target = pd.read_csv('data/output/target_2.tsv', sep='\t')
+        pqd.tsv_to_parquet('data/output/target_2.tsv', 'data/output/test.parquet', abundance_dtype='uint32',
+                           chunksize=2, row_group_size=2)
+        self.assertEqual(pqd.parquet_columns('data/output/test.parquet'),
+                         (list(target.columns[:5]), list(target.columns[5:])))
+
+        res = pqd.read_parquet_dataset('data/output/test.parquet')
+        self.assertTrue((res.iloc[:, 5:].dtypes == 'uint32').all())
+        self.assertTrue(res.astype({col: 'int64' for col in res.columns[5:]}).equals(target))
+
+        res = pqd.read_parquet_dataset('data/output/test.parquet', features=['go2', 'taxa4'], metadata=['biome'],
+                                       filters=[('study_id', '==', 'study2')])
+        self.assertEqual(list(res.columns), ['biome', 'go2', 'taxa4'])
+        self.assertEqual(list(res['go2']), [3, 0])
+
+        study_dict = {'study1': ['ERP104187_GO_abundances_v4.1.tsv', 'ERP104187_taxonomy_abundances_SSU_v4.1.tsv'],
+                      'study2': ['ERP104188_GO_abundances_v4.1.tsv', 'ERP104188_taxonomy_abundances_SSU_v4.1.tsv']}
+        agg.generate_all_aggregated_streaming(study_dict, None, 'data/studies', parquet_path='data/output/test.parquet')
+        res = pqd.read_parquet_dataset('data/output/test.parquet')
+        pd.testing.assert_frame_equal(res, pd.read_csv('data/output/target.tsv', sep='\t'), check_dtype=False)
+        os.remove('data/output/test.parquet')
+
+    def test_parquet_dataset_fractional_chunk(self):
+        target = pd.DataFrame({'id': ['id{}'.format(i) for i in range(6)], 'study_id': ['study1'] * 6,
+                               'go1': [1, 2, 3, 4, 5, 6], 'taxa1': [0, 1, 0, 1, 0.5, 1]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tsv_path = os.path.join(tmp_dir, 'fractional.tsv')
+            parquet_path = os.path.join(tmp_dir, 'fractional.parquet')
+            target.to_csv(tsv_path, sep='\t', index=False)
+            # the only fractional value is in the third chunk
+            pqd.tsv_to_parquet(tsv_path, parquet_path, chunksize=2)
+            res = pqd.read_parquet_dataset(parquet_path)
+            self.assertTrue((res.iloc[:, 2:].dtypes == 'float64').all())
+            pd.testing.assert_frame_equal(res, target, check_dtype=False)
+
+            with self.assertRaisesRegex(ValueError, 'abundance_dtype'):
+                with pqd.ParquetDatasetWriter(parquet_path, target.columns) as writer:
+                    writer.write(target.iloc[:2].astype({'taxa1': 'int64'}))
+                    writer.write(target.iloc[4:])
+
+    def test_update_aggregated(self):
+        study_dict = {'study1': ['ERP104187_GO_abundances_v4.1.tsv', 'ERP104187_taxonomy_abundances_SSU_v4.1.tsv'],
+                      'study2': ['ERP104188_GO_abundances_v4.1.tsv', 'ERP104188_taxonomy_abundances_SSU_v4.1.tsv']}
+        target = pd.read_csv('data/output/target.tsv', sep='\t')
+        prefix = 'data/output/test_incremental'
+
+        self.assertEqual(inc.update_aggregated({'study1': study_dict['study1']}, 'data/studies', prefix,
+                                               use_hash=True), ['study1'])
+        res = sm.load_sparse_aggregated_df(prefix, dense=True)
+        self.assertEqual(list(res.columns), ['id', 'study_id', 'go1', 'go2', 'go3', 'taxa1', 'taxa2', 'taxa3'])
+
+        # only study2 is read, go4 and taxa4 are zero filled for study1 rows
+        self.assertEqual(inc.update_aggregated(study_dict, 'data/studies', prefix, use_hash=True), ['study2'])
+        pd.testing.assert_frame_equal(sm.load_sparse_aggregated_df(prefix, dense=True), target, check_dtype=False)
+        self.assertEqual(inc.update_aggregated(study_dict, 'data/studies', prefix), [])
+        self.assertEqual(inc.load_manifest(prefix)['go_terms'], ['go1', 'go2', 'go3', 'go4'])
+        for suffix in ['.npz', '_rows.tsv', '_columns.tsv', '_manifest.json']:
+            os.remove(prefix + suffix)
+
+    def test_compact_dtype(self):
+        self.assertEqual(dtypes.compact_dtype(np.array([0, 3, 255])), np.uint8)
+        self.assertEqual(dtypes.compact_dtype(np.array([0, 70000])), np.uint32)
+        self.assertEqual(dtypes.compact_dtype(np.array([0., 300.])), np.uint16)
+        self.assertEqual(dtypes.compact_dtype(np.array([-1, 300])), np.int16)
+        self.assertEqual(dtypes.compact_dtype(np.array([0.5, 3.])), np.float64)
+        self.assertEqual(dtypes.compact_dtype(np.array([np.nan, 3.])), np.float64)
+        df = dtypes.read_abundance_tsv('data/output/target.tsv', start_col_index=2)
+        self.assertTrue((df.dtypes.iloc[2:] == np.uint8).all())
+        # labelled layout, the metadata columns in the abundance range are skipped
+        df = dtypes.read_abundance_tsv('data/output/target_2.tsv', start_col_index=2)
+        self.assertEqual(df['biome'].iloc[0], 'root:Environmental:Aquatic:Marine')
+        self.assertFalse(pd.api.types.is_numeric_dtype(df['exptype']))
+        self.assertTrue((df.dtypes.iloc[5:] == np.uint8).all())
+
     def test_regex_filtered(self):
         my_list = ['biomes.json',
                    '.ipynb_checkpoints',
@@ -63,5 +242,57 @@ class MyTestCase(unittest.TestCase):
         self.assertTrue(filecmp.cmp('data/output/test_write_new_file.tsv', 'data/output/target_2.tsv'))
 
 
+    def test_metadata_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_path = os.path.join(tmp_dir, 'metadata.db')
+            output_file = os.path.join(tmp_dir, 'test_write_new_file.tsv')
+            eb.build_metadata_index("data/studies/", index_path)
+            conn = sqlite3.connect(index_path)
+            self.assertEqual(eb.lookup_metadata(conn, "study1", "SRRid3"),
+                             ("SRS009923", "root:Environmental:Aquatic:Water", "metagenomic"))
+            self.assertEqual(eb.lookup_metadata(conn, "study2", "ERZid7"),
+                             ("SRS009927", "root:Environmental:Aquatic:Marine", "undefined"))
+            self.assertEqual(eb.lookup_metadata(conn, "study2", "ERZid9"), (None, None, None))
+            self.assertEqual(eb.lookup_metadata(conn, "study1", "ERZid7"), (None, None, None))
+            conn.close()
+
+            eb.write_new_file("data/studies/", 'data/output/target.tsv', output_file, 5, index_path=index_path)
+            self.assertTrue(filecmp.cmp(output_file, 'data/output/target_2.tsv', shallow=False))
+
+
+    def test_write_new_file_mixed_id_types(self):
+        # study3 has run and assembly rows, interleaved so no id type is resolved from an earlier row
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = os.path.join(tmp_dir, 'mixed.tsv')
+            with open(input_file, 'w') as f:
+                f.write("id\tstudy_id\tgo1\nSRRid10\tstudy3\t1\nERZid11\tstudy3\t2\nERRid12\tstudy3\t3\n")
+            target = pd.DataFrame({'id': ['SRRid10', 'ERZid11', 'ERRid12'], 'study_id': ['study3'] * 3,
+                                   'sample_id': ['SRS009930', 'SRS009931', 'SRS009932'],
+                                   'biome': ['root:Mixed', 'root:Engineered', 'root:Host-associated'],
+                                   'exptype': ['metagenomic', 'assembly', 'metatranscriptomic'], 'go1': [1, 2, 3]})
+            index_path = os.path.join(tmp_dir, 'metadata.db')
+            eb.build_metadata_index("data/studies/", index_path)
+            for case, kwargs in [('json', {}), ('index', {'index_path': index_path})]:
+                with self.subTest(case):
+                    output_file = os.path.join(tmp_dir, 'mixed_%s.tsv' % case)
+                    eb.write_new_file("data/studies/", input_file, output_file, 3, **kwargs)
+                    self.assertTrue(pd.read_csv(output_file, sep='\t').equals(target))
+                    self.assertEqual(eb.join_biome("data/studies/", input_file, output_file, **kwargs), 3)
+                    self.assertTrue(pd.read_csv(output_file, sep='\t').equals(target))
+
+    def test_join_biome(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file = os.path.join(tmp_dir, 'joined.tsv')
+            kept = eb.join_biome("data/studies/", 'data/output/target.tsv', output_file)
+            self.assertEqual(kept, 4)
+            self.assertTrue(filecmp.cmp(output_file, 'data/output/target_2.tsv', shallow=False))
+
+            eb.join_biome("data/studies/", 'data/output/target.tsv', output_file, sidecar=True)
+            sidecar = pd.read_csv(output_file, sep='\t')
+            target = pd.read_csv('data/output/target_2.tsv', sep='\t')
+            self.assertEqual(list(sidecar['row']), [0, 1, 2, 3])
+            self.assertTrue(sidecar.iloc[:, 1:].equals(target.iloc[:, :5]))
+
+
 if __name__ == '__main__':
     unittest.main()